@@ -1,90 +1,409 @@
-import pygame, random, time
-from pygame_util import SceneManager, Scene
-
-class Tile:
-    def __init__(self, 
-                 x, 
-                 y, 
-                 sprite: pygame.Surface, 
-                 sprite_id: int) -> None:
-        self.x = x
-        self.y = y
-        self.sprite = sprite
-        self.sprite_id = sprite_id
-
-    def update(self) -> None:
-        pass
-
-    def render(self) -> None:
-        pass
-
+import pygame, math, collections, heapq, itertools, threading, weakref
+import numpy as np
+from pygame_util import SceneManager, Scene, Entity, EntityStore, ObjectPool, SpatialHash, UpdateScheduler, RenderQueue, TileMapFile, TEXT_CACHE, TRANSFORM_CACHE, lerp, asset_path, init_display, run_from_command_line
+
+# Unit vectors for the four movement directions
+DIRECTIONS = {"up": (0, -1),
+              "down": (0, 1),
+              "left": (-1, 0),
+              "right": (1, 0)}
+
+# Render queue layers, back to front
+LAYER_TILES = 0
+LAYER_ACTORS = 1
+LAYER_UI = 2
+# Profiler sections the layers' draw time is reported under
+LAYER_NAMES = {LAYER_TILES: "tiles", LAYER_ACTORS: "entities", LAYER_UI: "ui"}
+
+# Properties of tiles in the tiles sheet, by sprite id. Anything not listed is walkable floor.
+# An animation is (frame sprite ids, seconds per frame), placed by using its first frame.
+TILE_PROPERTIES = {11: {"animation": ((11, 12, 13, 14), 0.25)}, # Waves
+                   22: {"animation": ((22, 23, 24, 25), 0.25)},
+                   69: {"solid": True},  # Bottom wall
+                   79: {"solid": True},  # Right wall
+                   81: {"solid": True},  # Left wall
+                   91: {"solid": True},  # Top wall
+                   101: {"solid": True}, # Corners
+                   102: {"solid": True},
+                   112: {"solid": True},
+                   113: {"solid": True}}
+
+# Sliced and scaled frames are shared through Tileset.shared(), keyed by the source sheet
+# plus tile size and scale, so every animation built from the same sheet reuses one set
+# of frames. A Tileset keeps only its frames, never the sheet itself, so the weak cache
+# entry goes away with the sheet once the asset manager releases it.
 class Tileset:
+    cache = weakref.WeakKeyDictionary() # sheet -> {(tilesize, scale_factor): Tileset}
+    cache_lock = threading.Lock()
+
     def __init__(self,
                  filename: str,
                  original_tilesize: int,
                  scale_factor: int = 1,
                  sprites = None) -> None:
         if sprites is None:
-            self.tilesheet = pygame.image.load(filename).convert_alpha()
+            tilesheet = pygame.image.load(filename).convert_alpha()
         else:
-            self.tilesheet = sprites
+            tilesheet = sprites
 
         self.tileset = {} # dict of tile ids to tile images 
         self.tilesize = original_tilesize
         self.scale_factor = scale_factor
         self.scaled_size = self.tilesize * self.scale_factor
 
+        # The whole sheet is scaled once and the tiles are views into it. Unscaled tiles
+        # view a copy, since a subsurface keeps its parent alive.
+        scaled_sheet = TRANSFORM_CACHE.get(tilesheet, scale=self.scale_factor)
+        if scaled_sheet is tilesheet:
+            scaled_sheet = tilesheet.copy()
+
         tile_id = 0
-        for y in range(int(self.tilesheet.get_height()/self.tilesize)):
-            for x in range(int(self.tilesheet.get_width()/self.tilesize)):
-                tile_rect = pygame.Rect(x*self.tilesize, 
-                                        y*self.tilesize, 
-                                        self.tilesize, 
-                                        self.tilesize)
-                tile_image = self.tilesheet.subsurface(tile_rect)
-
-                tile_image = pygame.transform.scale(tile_image,
-                                                    (tile_image.get_width() * self.scale_factor,
-                                                    tile_image.get_height() * self.scale_factor))
+        for y in range(int(tilesheet.get_height()/self.tilesize)):
+            for x in range(int(tilesheet.get_width()/self.tilesize)):
+                tile_rect = pygame.Rect(x*self.scaled_size, 
+                                        y*self.scaled_size, 
+                                        self.scaled_size, 
+                                        self.scaled_size)
+                tile_image = scaled_sheet.subsurface(tile_rect)
                 
                 self.tileset[tile_id] = tile_image
 
                 tile_id += 1
 
+    @classmethod
+    def shared(cls, sprites: pygame.Surface, original_tilesize: int, scale_factor: int = 1) -> "Tileset":
+        with cls.cache_lock:
+            tilesets = cls.cache.setdefault(sprites, {})
+            key = (original_tilesize, scale_factor)
+            if key not in tilesets:
+                tilesets[key] = cls("none", original_tilesize, scale_factor, sprites)
+            return tilesets[key]
+
     def get_tileset(self) -> dict:
         return self.tileset
     
     def get_tile_sprite(self, id: int) -> pygame.Surface:
         return self.tileset[id]
 
+# One bit per cell saying whether it blocks movement. A chunk is packed the first time one
+# of its cells is looked up, so opening a large map stays instant. Cells outside the map
+# count as solid.
+class CollisionMask:
+    def __init__(self, map_file: TileMapFile, solid_ids) -> None:
+        if map_file.chunk_size % 8 != 0:
+            raise ValueError("CollisionMask needs a chunk size that is a multiple of 8")
+        self.map_file = map_file
+        self.chunk_size = map_file.chunk_size
+        self.solid_lookup = np.zeros(TileMapFile.EMPTY + 1, dtype=bool)
+        self.solid_lookup[list(solid_ids)] = True
+
+        self.bits = np.zeros((map_file.chunks_y * self.chunk_size,
+                              map_file.chunks_x * self.chunk_size // 8), dtype=np.uint8)
+        self.packed = np.zeros((map_file.chunks_y, map_file.chunks_x), dtype=bool)
+        self.version = 0 # Bumped on every change, so flow fields know to rebuild
+
+    def pack_chunk(self, chunk_x: int, chunk_y: int) -> None:
+        size = self.chunk_size
+        solid = self.solid_lookup[self.map_file.get_chunk(chunk_x, chunk_y)].any(axis=0)
+        self.bits[chunk_y * size:(chunk_y + 1) * size,
+                  chunk_x * size // 8:(chunk_x + 1) * size // 8] = np.packbits(solid, axis=1)
+        self.packed[chunk_y, chunk_x] = True
+
+    # Repacks a cell's chunk the next time it is looked up
+    def invalidate(self, x: int, y: int) -> None:
+        self.invalidate_chunk(x // self.chunk_size, y // self.chunk_size)
+
+    def invalidate_chunk(self, chunk_x: int, chunk_y: int) -> None:
+        self.packed[chunk_y, chunk_x] = False
+        self.version += 1
+
+    # Solid flags for a block of cells as a (height, width) array, unpacked in one go
+    def region(self, left: int, top: int, width: int, height: int) -> np.ndarray:
+        solid = np.ones((height, width), dtype=bool)
+        x0, y0 = max(left, 0), max(top, 0)
+        x1, y1 = min(left + width, self.map_file.width), min(top + height, self.map_file.height)
+        if x0 >= x1 or y0 >= y1:
+            return solid
+
+        for chunk_y in range(y0 // self.chunk_size, (y1 - 1) // self.chunk_size + 1):
+            for chunk_x in range(x0 // self.chunk_size, (x1 - 1) // self.chunk_size + 1):
+                if not self.packed[chunk_y, chunk_x]:
+                    self.pack_chunk(chunk_x, chunk_y)
+
+        first_byte = x0 // 8
+        bits = np.unpackbits(self.bits[y0:y1, first_byte:(x1 + 7) // 8], axis=1).view(bool)
+        solid[y0 - top:y1 - top, x0 - left:x1 - left] = bits[:, x0 - first_byte * 8:x1 - first_byte * 8]
+        return solid
+
+    def is_solid(self, x: int, y: int) -> bool:
+        if not (0 <= x < self.map_file.width and 0 <= y < self.map_file.height):
+            return True
+        chunk_x = x // self.chunk_size
+        chunk_y = y // self.chunk_size
+        if not self.packed[chunk_y, chunk_x]:
+            self.pack_chunk(chunk_x, chunk_y)
+        return bool(self.bits[y, x >> 3] & (0x80 >> (x & 7)))
+
+# Walking distance from every cell near a goal to the goal, from one breadth-first search
+# over the collision mask. Each enemy steers by looking up its own cell, so pathing costs
+# the same for one enemy or a thousand. The search covers cells within `radius` of the
+# goal and only reruns when the goal changes cell or the map changes.
+class FlowField:
+    NEIGHBOURS = ((1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (1, -1), (-1, 1), (-1, -1))
+
+    def __init__(self, mask: CollisionMask, radius: int = 32) -> None:
+        self.mask = mask
+        self.radius = radius
+        self.size = radius * 2 + 1
+        self.goal = None
+        self.version = None
+        self.left = 0
+        self.top = 0
+        self.distances = [] # Flattened size x size grid, -1 where the goal can't be reached
+        self.builds = 0
+
+    def update(self, goal_x: int, goal_y: int) -> None:
+        if (goal_x, goal_y) == self.goal and self.mask.version == self.version:
+            return
+        self.goal = (goal_x, goal_y)
+        self.version = self.mask.version
+        self.left = goal_x - self.radius
+        self.top = goal_y - self.radius
+        self.builds += 1
+
+        size = self.size
+        cells = size * size
+        walkable = (~self.mask.region(self.left, self.top, size, size)).ravel().tolist()
+        distances = [-1] * cells
+        start = self.radius * size + self.radius
+        distances[start] = 0
+        queue = collections.deque([start])
+        while queue:
+            i = queue.popleft()
+            distance = distances[i] + 1
+            column = i % size
+            for n in (i - 1 if column > 0 else -1, i + 1 if column < size - 1 else -1, i - size, i + size):
+                if 0 <= n < cells and distances[n] < 0 and walkable[n]:
+                    distances[n] = distance
+                    queue.append(n)
+        self.distances = distances
+
+    def get_distance(self, x: int, y: int) -> int:
+        x -= self.left
+        y -= self.top
+        if 0 <= x < self.size and 0 <= y < self.size:
+            return self.distances[y * self.size + x]
+        return -1
+
+    # Unit vector toward the neighbouring cell closest to the goal, without cutting wall
+    # corners. (0, 0) at the goal and wherever the goal can't be reached.
+    def get_direction(self, x: int, y: int) -> tuple:
+        best_distance = self.get_distance(x, y)
+        if best_distance <= 0:
+            return (0, 0)
+
+        best = None
+        for dx, dy in self.NEIGHBOURS:
+            distance = self.get_distance(x + dx, y + dy)
+            if 0 <= distance < best_distance:
+                if dx and dy and (self.get_distance(x + dx, y) < 0 or self.get_distance(x, y + dy) < 0):
+                    continue
+                best = (dx, dy)
+                best_distance = distance
+
+        if best is None:
+            return (0, 0)
+        if best[0] and best[1]:
+            return (best[0] * math.sqrt(0.5), best[1] * math.sqrt(0.5))
+        return best
+
+# A tile that cycles through frames of the tileset. It keeps no timing of its own: the frame
+# comes from the tilemap's shared clock, so every copy of the tile stays in step.
+class TileAnimation:
+    def __init__(self, frames: tuple, frequency: float) -> None:
+        self.frames = frames
+        self.frequency = frequency
+
+    def get_frame(self, clock: float) -> int:
+        return self.frames[int(clock / self.frequency) % len(self.frames)]
+
+# Streams a TileMapFile. The grid itself is the file's uint16 array, and world positions
+# are worked out from cell indices when needed. Chunks are baked into surfaces the first
+# time they are near the camera or its subject, and kept in an LRU cache of cache_size
+# chunks. Memory stays bounded however large the map is, and opening a map reads nothing
+# but its header.
 class Tilemap:
     def __init__(self,
-                 map: list[list],
-                 tileset: Tileset) -> None:
+                 map_file: TileMapFile,
+                 tileset: Tileset,
+                 tile_properties: dict = None,
+                 cache_size: int = 16,
+                 stream_radius: int = 1) -> None:
+        self.map_file = map_file
         self.tileset = tileset
-        self.map_spec = map
-        self.map = [[]]
         self.tilesize = self.tileset.scaled_size
-
-        # Create map tiles from spec
-        x_coord = 0
-        y_coord = 0
-        for y in self.map_spec:
-            row = []
-            for x in y:
-                sprite = self.tileset.get_tile_sprite(x)
-                tile = Tile(x_coord, y_coord, sprite, x)
-                row.append(tile)
-                x_coord += self.tilesize
-            y_coord += self.tilesize
-            x_coord = 0
-            self.map.append(row)
-
+        self.width = map_file.width
+        self.height = map_file.height
+        self.chunk_size = map_file.chunk_size
+        self.chunk_pixels = self.chunk_size * self.tilesize
+        self.cache_size = cache_size
+        self.stream_radius = stream_radius
+        self.chunks = collections.OrderedDict() # (chunk_x, chunk_y) -> baked surface, oldest first
+        self.stream_center = None
+
+        tile_properties = tile_properties or {}
+        self.solid = CollisionMask(map_file, [tile_id for tile_id, properties in tile_properties.items()
+                                              if properties.get("solid")])
+
+        # Animated tiles are left out of the baked chunks. Each baked chunk that has any gets
+        # an entry in animated_cells, and they are drawn over the chunk every frame.
+        self.tile_animations = {tile_id: TileAnimation(*properties["animation"])
+                                for tile_id, properties in tile_properties.items() if "animation" in properties}
+        self.animated_cells = {} # (chunk_x, chunk_y) -> [(world x, world y, TileAnimation), ...]
+        self.clock = 0.0
+
+    def get_tile(self, x: int, y: int, layer: int = 0) -> int:
+        return self.map_file.get_tile(x, y, layer)
+
+    # Swaps the tile at a grid position; its chunk is re-baked the next time it is needed
+    def set_tile(self, x: int, y: int, sprite_id: int, layer: int = 0) -> None:
+        self.map_file.set_tile(x, y, sprite_id, layer)
+        self.mark_dirty([(x // self.chunk_size, y // self.chunk_size)])
+
+    # Writes a (height, width) block of tile ids with its top left cell at (x, y)
+    def set_tiles(self, x: int, y: int, tile_ids, layer: int = 0) -> None:
+        self.mark_dirty(self.map_file.set_region(x, y, tile_ids, layer))
+
+    # Drops the baked surfaces and collision bits of changed chunks
+    def mark_dirty(self, chunk_keys) -> None:
+        for key in chunk_keys:
+            self.chunks.pop(key, None)
+            self.animated_cells.pop(key, None)
+            self.solid.invalidate_chunk(*key)
+
+    # Advances the clock every animated tile is sampled from
+    def update(self, dt: float) -> None:
+        self.clock += dt
+
+    # The cells under a world-space rect: (left, top, ids) with ids a (rows, columns) array
+    def tiles_in_rect(self, rect: pygame.Rect, layer: int = 0) -> tuple:
+        left, top = self.cell_at(rect.left, rect.top)
+        right, bottom = self.cell_at(rect.right - 1, rect.bottom - 1)
+        return left, top, self.map_file.get_region(left, top, right - left + 1, bottom - top + 1, layer)
+
+    # (x, y) cells holding a tile id, as an (n, 2) array, optionally only under a world rect
+    def find_tiles(self, sprite_id: int, rect: pygame.Rect = None, layer: int = 0) -> np.ndarray:
+        if rect is None:
+            return self.map_file.find_tiles(sprite_id, layer)
+        left, top, ids = self.tiles_in_rect(rect, layer)
+        rows, columns = np.nonzero(ids == sprite_id)
+        return np.column_stack((columns + left, rows + top))
+
+    def cell_at(self, x: float, y: float) -> tuple:
+        return (int(x // self.tilesize), int(y // self.tilesize))
+
+    def cell_rect(self, x: int, y: int) -> pygame.Rect:
+        return pygame.Rect(x * self.tilesize, y * self.tilesize, self.tilesize, self.tilesize)
+
+    # True if any cell under a world-space box is solid
+    def is_blocked(self, left: float, top: float, width: float, height: float) -> bool:
+        for y in range(int(top // self.tilesize), int((top + height - 1) // self.tilesize) + 1):
+            for x in range(int(left // self.tilesize), int((left + width - 1) // self.tilesize) + 1):
+                if self.solid.is_solid(x, y):
+                    return True
+        return False
+
+    # Undoes whichever axis of an entity's last move ran it into a solid cell, horizontal
+    # first so it slides along walls. Returns True if it was blocked at all.
+    def resolve_movement(self, entity: Entity) -> bool:
+        x, y = entity.x, entity.y
+        blocked = False
+        if x != entity.previous_x and self.is_blocked(x, entity.previous_y, entity.w, entity.h):
+            x = entity.previous_x
+            blocked = True
+        if y != entity.previous_y and self.is_blocked(x, y, entity.w, entity.h):
+            y = entity.previous_y
+            blocked = True
+        if blocked:
+            entity.x = x
+            entity.y = y
+        return blocked
+
+    def bake_chunk(self, chunk_x: int, chunk_y: int) -> pygame.Surface:
+        surface = pygame.Surface((self.chunk_pixels, self.chunk_pixels), pygame.SRCALPHA)
+        blits = []
+        animated = []
+        origin_x = chunk_x * self.chunk_pixels
+        origin_y = chunk_y * self.chunk_pixels
+        for layer in self.map_file.get_chunk(chunk_x, chunk_y).tolist():
+            for row, ids in enumerate(layer):
+                for column, sprite_id in enumerate(ids):
+                    if sprite_id in self.tile_animations:
+                        animated.append((origin_x + column * self.tilesize, origin_y + row * self.tilesize,
+                                         self.tile_animations[sprite_id]))
+                    elif sprite_id != TileMapFile.EMPTY:
+                        blits.append((self.tileset.get_tile_sprite(sprite_id),
+                                      (column * self.tilesize, row * self.tilesize)))
+        surface.blits(blits, False)
+
+        if animated:
+            self.animated_cells[(chunk_x, chunk_y)] = animated
+        else:
+            self.animated_cells.pop((chunk_x, chunk_y), None)
+        return surface.convert_alpha()
+
+    # The baked chunk, paging it in (and evicting the least recently used) if needed
+    def get_chunk(self, chunk_x: int, chunk_y: int) -> pygame.Surface:
+        key = (chunk_x, chunk_y)
+        if key in self.chunks:
+            self.chunks.move_to_end(key)
+            return self.chunks[key]
+
+        chunk = self.chunks[key] = self.bake_chunk(chunk_x, chunk_y)
+        while len(self.chunks) > self.cache_size:
+            evicted, _ = self.chunks.popitem(last=False)
+            self.animated_cells.pop(evicted, None)
+        return chunk
+
+    def in_bounds(self, chunk_x: int, chunk_y: int) -> bool:
+        return 0 <= chunk_x < self.map_file.chunks_x and 0 <= chunk_y < self.map_file.chunks_y
+
+    # Pages in the chunks around a world position, once each time it enters a new chunk
+    def stream(self, x: float, y: float) -> None:
+        center = (int(x // self.chunk_pixels), int(y // self.chunk_pixels))
+        if center == self.stream_center:
+            return
+        self.stream_center = center
+
+        for chunk_y in range(center[1] - self.stream_radius, center[1] + self.stream_radius + 1):
+            for chunk_x in range(center[0] - self.stream_radius, center[0] + self.stream_radius + 1):
+                if self.in_bounds(chunk_x, chunk_y):
+                    self.get_chunk(chunk_x, chunk_y)
+
+    # Queues only the chunks overlapping the camera's view, then the animated tiles in them
+    # that are actually on screen
+    def render(self, queue: RenderQueue, view: pygame.Rect) -> None:
+        for chunk_y in range(view.top // self.chunk_pixels, (view.bottom - 1) // self.chunk_pixels + 1):
+            for chunk_x in range(view.left // self.chunk_pixels, (view.right - 1) // self.chunk_pixels + 1):
+                if not self.in_bounds(chunk_x, chunk_y):
+                    continue
+                queue.submit(self.get_chunk(chunk_x, chunk_y),
+                             (chunk_x * self.chunk_pixels - view.x, chunk_y * self.chunk_pixels - view.y),
+                             LAYER_TILES)
+
+                for x, y, animation in self.animated_cells.get((chunk_x, chunk_y), ()):
+                    if view.left - self.tilesize < x < view.right and view.top - self.tilesize < y < view.bottom:
+                        queue.submit(self.tileset.get_tile_sprite(animation.get_frame(self.clock)),
+                                     (x - view.x, y - view.y), LAYER_TILES)
+
+# The active region is the view grown by active_margin on every side; world objects
+# outside it are put to sleep or despawned by the scene
 class Camera:
-    def __init__(self, screen: pygame.surface, subject) -> None:
+    def __init__(self, screen: pygame.surface, subject, active_margin: int = 640) -> None:
         self.screen = screen
         self.screen_w = screen.get_width()
         self.screen_h = screen.get_height()
+        self.active_margin = active_margin
 
         self.subject = subject
         self.camera_adjustment_x = 0
@@ -94,8 +413,21 @@ class Camera:
         self.camera_adjustment_x = (self.screen_w/2) - self.subject.x
         self.camera_adjustment_y = (self.screen_h/2) - self.subject.y
 
-    def get_camera_adjustment(self) -> tuple:
-        return (self.camera_adjustment_x, self.camera_adjustment_y)
+    # With an alpha the adjustment follows the subject's interpolated render position
+    def get_camera_adjustment(self, alpha: float = None) -> tuple:
+        if alpha is None:
+            return (self.camera_adjustment_x, self.camera_adjustment_y)
+        return ((self.screen_w/2) - lerp(self.subject.previous_x, self.subject.x, alpha),
+                (self.screen_h/2) - lerp(self.subject.previous_y, self.subject.y, alpha))
+
+    # World-space rectangle covered by the screen, snapped the same way blits are
+    def get_view_rect(self, alpha: float = None, margin: int = 0) -> pygame.Rect:
+        adjust_x, adjust_y = self.get_camera_adjustment(alpha)
+        view = pygame.Rect(-math.floor(adjust_x), -math.floor(adjust_y), self.screen_w, self.screen_h)
+        return view.inflate(margin * 2, margin * 2)
+
+    def get_active_rect(self) -> pygame.Rect:
+        return self.get_view_rect(margin=self.active_margin)
 
     def update(self, dt) -> None:
         self.camera_adjustment_x = (self.screen_w/2) - self.subject.x
@@ -109,11 +441,10 @@ class Button:
         self.x = x
         self.y = y
 
-        self.font = pygame.font.SysFont("Calibri", 36)
         self.color = "white"
         self.text = text
 
-        self.text_surface = self.font.render(self.text, True, self.color)
+        self.text_surface = TEXT_CACHE.render(self.text, "Calibri", 36, self.color)
         self.rect = self.text_surface.get_rect()
         self.rect.x = self.x
         self.rect.y = self.y
@@ -122,12 +453,12 @@ class Button:
 
         self.event = lambda: print("Default Button")
 
+    # The surface is only looked up again when the hover colour actually changes
     def update(self, dt):
-        if self.hovered is True:
-            self.color = "blue"
-        else:
-            self.color = "white"
-        self.text_surface = self.font.render(self.text, True, self.color)
+        color = "blue" if self.hovered is True else "white"
+        if color != self.color:
+            self.color = color
+            self.text_surface = TEXT_CACHE.render(self.text, "Calibri", 36, self.color)
 
     def set_hover(self, hovered: bool):
         self.hovered = hovered
@@ -135,18 +466,39 @@ class Button:
     def register_event(self, func):
         self.event = func
 
-    def render(self, screen: pygame.surface):
-        screen.blit(self.text_surface, (self.x, self.y,))
+    def render(self, queue: RenderQueue):
+        queue.submit(self.text_surface, (self.x, self.y), LAYER_UI)
 
-class Player:
-    def __init__(self, spritesheets: dict, x, y) -> None:
-        self.x = x
-        self.y = y
+# The time every animation in a scene is sampled from. Non-looping animations register
+# when they will end, so advance() can report them finishing without any per-entity update.
+class AnimationClock:
+    def __init__(self) -> None:
+        self.time = 0.0
+        self.pending = [] # Heap of (end time, order, manager, activation)
+        self.order = itertools.count()
+
+    def schedule(self, end_time: float, manager, activation: int) -> None:
+        heapq.heappush(self.pending, (end_time, next(self.order), manager, activation))
+
+    # Returns the (manager, animation name) of every non-looping animation that finished
+    def advance(self, dt: float) -> list:
+        self.time += dt
+        finished = []
+        while self.pending and self.pending[0][0] <= self.time:
+            _, _, manager, activation = heapq.heappop(self.pending)
+            if manager.activation == activation: # Not replaced by another animation since
+                finished.append((manager, manager.active_animation.name))
+        return finished
+
+# Position and motion live in the scene's EntityStore, which integrates them all at once
+class Player(Entity):
+    def __init__(self, store: EntityStore, spritesheets: dict, clock: AnimationClock, x, y) -> None:
+        super().__init__(store, x, y, 64, 64)
         self.velocity = 250
         self.direction = "down"
         self.moving = False
 
-        self.animations = AnimationManager(spritesheets, 16, 4)
+        self.animations = AnimationManager(spritesheets, 16, 4, clock)
 
         # Walking animations
         self.animations.register_animation("walking_right", [3, 7, 11, 15], "walking_animations")
@@ -166,65 +518,80 @@ class Player:
         self.animations.register_animation("attack_left", [2, 2, 2], "attack_animation")
         self.animations.register_animation("attack_right", [3, 3, 3], "attack_animation")
 
-    def move(self, dt) -> None:
-        if self.direction == "up":
-            self.y -= self.velocity * dt
-        elif self.direction == "down":
-            self.y += self.velocity * dt
-        elif self.direction == "left":
-            self.x -= self.velocity * dt
-        elif self.direction == "right":
-            self.x += self.velocity * dt
+    # Points the stored velocity along the current direction, or zeroes it when stopped
+    def update_velocity(self) -> None:
+        speed = self.velocity if self.moving else 0
+        self.vx = DIRECTIONS[self.direction][0] * speed
+        self.vy = DIRECTIONS[self.direction][1] * speed
 
     def attack(self) -> None:
         self.animations.activate_animation("attack_" + self.direction, 0.1, False)
 
     def set_direction(self, new_direction: str) -> None:
         self.direction = new_direction
+        self.update_velocity()
 
     def start_moving(self, animation: str) -> None:
         self.moving = True
+        self.update_velocity()
         self.animations.activate_animation(animation, 0.15, True)
 
     def stop_moving(self) -> None:
         self.moving = False
+        self.update_velocity()
         self.animations.activate_animation("stationary_" + self.direction, 0.1, True)
 
-    def update(self, dt) -> None:
+    # Goes back to walking or standing once the attack animation has played out
+    def finish_attack(self) -> None:
         if self.moving:
-            self.move(dt)
-        
-        self.animations.update(dt)
+            self.animations.activate_animation("walking_" + self.direction, 0.15, True)
+        else:
+            self.animations.activate_animation("stationary_" + self.direction, 0.1, True)
     
-    def render(self, screen: pygame.surface, camera_adjust: tuple) -> None:
-        screen.blit(self.animations.get_current_sprite(), (self.x + camera_adjust[0], self.y + camera_adjust[1]))
+    def render(self, queue: RenderQueue, camera_adjust: tuple, alpha: float) -> None:
+        x, y = self.get_render_pos(alpha)
+        queue.submit(self.animations.get_current_sprite(), (x + camera_adjust[0], y + camera_adjust[1]), LAYER_ACTORS)
 
-class Enemy:
-    def __init__(self, spritesheets: dict, x, y) -> None:
+class Enemy(Entity):
+    def __init__(self, store: EntityStore, spritesheets: dict, clock: AnimationClock, x, y) -> None:
+        super().__init__(store, x, y, 200, 200)
         self.spritesheets = spritesheets
-        self.x = x
-        self.y = y
 
-        self.animations = AnimationManager(spritesheets, 50, 4)
+        self.animations = AnimationManager(spritesheets, 50, 4, clock)
         self.animations.register_animation("idle", [0, 1, 2, 3, 4], "enemy_idle")
         self.animations.activate_animation("idle", 0.1, True)
-    
-    def update(self, dt):
-        self.animations.update(dt)
+        self.health = 3
+        self.speed = 120
+
+    # Heads along the flow field from the cell under the enemy's centre
+    def steer(self, field: FlowField, tilemap: Tilemap) -> None:
+        direction = field.get_direction(*tilemap.cell_at(self.x + self.w / 2, self.y + self.h / 2))
+        self.vx = direction[0] * self.speed
+        self.vy = direction[1] * self.speed
+
+    def stop(self) -> None:
+        self.vx = 0
+        self.vy = 0
 
-    def render(self, screen: pygame.surface, camera_adjust: tuple):
-        screen.blit(self.animations.get_current_sprite(), (self.x + camera_adjust[0], self.y + camera_adjust[1]))
+    # Returns True once the enemy has taken its last hit
+    def hit(self) -> bool:
+        self.health -= 1
+        return self.health <= 0
+
+    def render(self, queue: RenderQueue, camera_adjust: tuple, alpha: float):
+        x, y = self.get_render_pos(alpha)
+        queue.submit(self.animations.get_current_sprite(), (x + camera_adjust[0], y + camera_adjust[1]), LAYER_ACTORS)
 
 
 class MenuScene(Scene):
+    next_scenes = ["main"]
+
     def __init__(self, 
                  manager: SceneManager, 
                  screen: pygame.Surface, 
                  sprites: dict) -> None:
         super().__init__(manager, screen, sprites)
 
-        self.previous_time = None
-
         # Create buttons
         self.quit_button = Button(500, 400, "Quit Game")
         self.start_button = Button(500, 300, "Start Game")
@@ -241,16 +608,11 @@ class MenuScene(Scene):
 
         self.buttons = [self.quit_button, self.start_button]
 
-    def update(self) -> None:
-        if self.previous_time is None:
-            self.previous_time = time.time()
-
-        # Delta time
-        now = time.time()
-        dt = now - self.previous_time
-        self.previous_time = now
+        # Tracked from mouse events rather than pygame.mouse.get_pos() so replays match
+        self.mouse_pos = (0, 0)
 
-        mouse_x, mouse_y = pygame.mouse.get_pos()
+    def update(self, dt: float) -> None:
+        mouse_x, mouse_y = self.mouse_pos
 
         for b in self.buttons:
             if b.hovered == False and b.rect.collidepoint(mouse_x, mouse_y):
@@ -261,56 +623,52 @@ class MenuScene(Scene):
         self.quit_button.update(dt)
         self.start_button.update(dt)
     
-    def render(self) -> None:
+    def render(self, alpha: float) -> None:
         self.screen.fill("black")
 
-        self.quit_button.render(self.screen)
-        self.start_button.render(self.screen)
-
-        pygame.display.update()
+        self.quit_button.render(self.manager.render_queue)
+        self.start_button.render(self.manager.render_queue)
 
-    def poll_events(self) -> None:
-        for event in pygame.event.get():
+    def poll_events(self, events: list) -> None:
+        for event in events:
             if event.type == pygame.QUIT:
                 self.manager.quit_game()
         # Mouse detection
+            if event.type == pygame.MOUSEMOTION:
+                self.mouse_pos = event.pos
             if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
                 for b in self.buttons:
                     if b.hovered:
                         b.event()
 
-class Projectile:
-    def __init__(self, spritesheets: dict, x, y) -> None:
+class Projectile(Entity):
+    def __init__(self, store: EntityStore, spritesheets: dict, clock: AnimationClock, x, y) -> None:
+        super().__init__(store, x, y, 32, 32)
         self.spritesheets = spritesheets
-        self.x = x
-        self.y = y
         self.velocity = 500
         self.direction = "right"
 
-        self.animation = AnimationManager(spritesheets, 16, 2)
+        self.animation = AnimationManager(spritesheets, 16, 2, clock)
         self.animation.register_animation("projectile", [0, 1, 2, 3, 4], "projectile")
         self.animation.activate_animation("projectile", 0.1, True)
+        self.set_direction(self.direction)
 
-    def move(self, dt) -> None:
-        if self.direction == "up":
-            self.y -= self.velocity * dt
-        elif self.direction == "down":
-            self.y += self.velocity * dt
-        elif self.direction == "left":
-            self.x -= self.velocity * dt
-        elif self.direction == "right":
-            self.x += self.velocity * dt
+    # Called by the projectile pool when a released projectile is fired again
+    def reset(self, x, y, direction: str) -> None:
+        self.spawn(x, y, 32, 32)
+        self.set_direction(direction)
+        self.animation.activate_animation("projectile", 0.1, True)
 
     def set_direction(self, new_direction: str) -> None:
         self.direction = new_direction
+        self.vx = DIRECTIONS[new_direction][0] * self.velocity
+        self.vy = DIRECTIONS[new_direction][1] * self.velocity
 
-    def update(self, dt):
-        self.animation.update(dt)
-        self.move(dt)
-
-    def render(self, screen: pygame.surface, camera_adjust: tuple):
-        screen.blit(self.animation.get_current_sprite(), (self.x + camera_adjust[0], self.y + camera_adjust[1]))
+    def render(self, queue: RenderQueue, camera_adjust: tuple, alpha: float):
+        x, y = self.get_render_pos(alpha)
+        queue.submit(self.animation.get_current_sprite(), (x + camera_adjust[0], y + camera_adjust[1]), LAYER_ACTORS)
 
+# The frames of one animation. It holds no playback state, so it can be shared freely.
 class Animation:
     def __init__(self,
                  name: str,
@@ -320,110 +678,74 @@ class Animation:
         self.tileset = tileset
         self.keyframes = keyframes
 
-        self.current_sprite_id = 0
-        self.loop_animation = False
-        self.animation_frequency = 0
-        self.current_keyframe = 0
-        self.keyframe_time = 0
-
-    def get_current_sprite(self) -> pygame.surface:
-        return self.tileset.get_tile_sprite(self.current_sprite_id)
-
-    def activate_animation(self, frequency: float, loop: bool):
-        self.animation_frequency = frequency
-        self.loop_animation = loop
-    
-    def deactivate_animation(self):
-        self.animation_frequency = 0
-        self.loop_animation = False
-
-    def update(self, dt) -> None:
-        self.keyframe_time += dt
-
-        if self.keyframe_time >= self.animation_frequency:
-            if len(self.keyframes) - 1 <= self.current_keyframe:
-
-                if self.loop_animation is True:
-                    self.current_keyframe = 0
-                else:
-                    self.deactivate_animation()
-            else:
-                self.current_keyframe += 1
-                self.current_sprite_id = self.keyframes[self.current_keyframe]
+    def get_duration(self, frequency: float) -> float:
+        return len(self.keyframes) * frequency
+
+    # The sprite id shown after playing for elapsed seconds. A finished animation holds
+    # its last frame.
+    def get_sprite_id(self, elapsed: float, frequency: float, loop: bool) -> int:
+        if frequency <= 0:
+            return self.keyframes[0]
+        keyframe = int(elapsed / frequency)
+        if loop:
+            keyframe %= len(self.keyframes)
+        else:
+            keyframe = min(keyframe, len(self.keyframes) - 1)
+        return self.keyframes[keyframe]
 
-            self.keyframe_time = 0
+    def get_sprite(self, elapsed: float, frequency: float, loop: bool) -> pygame.Surface:
+        return self.tileset.get_tile_sprite(self.get_sprite_id(elapsed, frequency, loop))
 
+# Playback is just the active animation, when it started on the clock, its frequency and
+# whether it loops. The current frame is worked out when the sprite is drawn.
 class AnimationManager:
     def __init__(self, 
                  spritesheets: dict,
                  tilesize: int,
-                 scale: int) -> None:
+                 scale: int,
+                 clock: AnimationClock) -> None:
         
         self.tilesets = {}
 
         for s in spritesheets:
-            tileset = Tileset("none", tilesize, scale, spritesheets[s])
+            tileset = Tileset.shared(spritesheets[s], tilesize, scale)
             self.tilesets[s] = tileset
 
         self.animations = {}
-
-        self.current_tileset = None
+        self.clock = clock
 
         self.active_animation = Animation("dummy", self.tilesets[list(self.tilesets.keys())[0]], [0])
+        self.start_time = clock.time
+        self.frequency = 0
+        self.loop = False
+        self.activation = 0 # Bumped on every activation, so stale completions are ignored
 
     def register_animation(self, name: str, sprite_ids: list[int], tileset: str):
         self.animations[name] = Animation(name, self.tilesets[tileset], sprite_ids)
 
-    def get_current_sprite(self) -> pygame.surface:
+    def get_current_sprite(self) -> pygame.Surface:
         if self.active_animation is not None:
-            return self.active_animation.get_current_sprite()
+            return self.active_animation.get_sprite(self.clock.time - self.start_time, self.frequency, self.loop)
         else:
-            return pygame.surface((0, 0))
-
-    def update(self, dt):
-        if self.active_animation is not None:
-            self.active_animation.update(dt)
+            return pygame.Surface((0, 0))
 
     def activate_animation(self, animation: str, frequency: float, loop: bool):
         self.active_animation = self.animations[animation]
-        self.active_animation.animation_frequency = frequency
-        self.active_animation.loop_animation = loop
+        self.start_time = self.clock.time
+        self.frequency = frequency
+        self.loop = loop
+        self.activation += 1
+        if not loop:
+            self.clock.schedule(self.start_time + self.active_animation.get_duration(frequency), self, self.activation)
     
     def deactivate_animation(self):
         self.active_animation = None
+        self.activation += 1
 
 class MainScene(Scene):
     def __init__(self, manager: SceneManager, screen: pygame.Surface, sprites: dict) -> None:
         super().__init__(manager, screen, sprites)
 
-        self.previous_time = None	
-
-        MAP     =      [[101,91,91,91,91,91,91,91,91,91,91,91,91,91,91,91,91,91,91,91,91,91,91,91,102], 
-                        [81,0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 79], 
-                        [81,0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,79], 
-                        [81,0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,71, 0, 0, 0, 0, 0, 0, 0, 0, 0,79], 
-                        [81, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,79],
-                        [81, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,79],
-                        [81, 0, 0, 0, 0, 0, 0, 0, 0,71, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,79],
-                        [81, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,79],
-                        [81, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,79],
-                        [81, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,71, 0, 0, 0, 0, 0, 0, 0, 0, 0,79],
-                        [81, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,79],
-                        [112,69,69,69,69,69,69,69,69,69,69,69,69,69,69,69,69,69,69,69,69,69,69,69,113]]
-
-        self.tileset = Tileset(r"Games\gfx\rpg_sprites.png", 16, 4)
-        # Create our tilemap
-        self.tilemap = Tilemap(MAP, self.tileset)
-
-        enemy_anims = {"enemy_idle": self.sprites["enemy_idle"]}
-        self.enemy = Enemy(enemy_anims, 500, 500)
-
-        player_anims = {"walking_animations": self.sprites["player_walk"],
-                        "attack_animation": self.sprites["player_attack"]}
-        self.player = Player(player_anims, 100, 100)  
-
-        self.camera = Camera(self.screen, self.player)
-
         # User input system
         self.keybinds = {pygame.K_w: "up",
                          pygame.K_s: "down",
@@ -435,43 +757,122 @@ class MainScene(Scene):
 
         self.projectiles = []
 
-    def update(self) -> None:
+        # Entities are drawn if their rect comes within this many pixels of the view,
+        # which covers the gap between their tick position and interpolated position
+        self.render_margin = 64
+
+    # Opening the map file only reads its header, so it can happen off the main thread
+    def prefetch(self) -> None:
+        super().prefetch()
+        # The world is streamed from disk, so nothing past the header is read here
+        self.map_file = TileMapFile(asset_path("maps/overworld.tmap"))
 
-        if self.previous_time is None: # First run through the loop needs a previous_time value to compute delta time
-            self.previous_time = time.time()
-        # Delta time
-        now = time.time()
-        dt = now - self.previous_time
-        self.previous_time = now
+    # Slicing the tileset and building the map happen here, on the main thread
+    def load(self) -> None:
+        super().load()
 
-        self.enemy.update(dt)
-        self.player.update(dt)
+        self.tileset = Tileset.shared(self.sprites["tiles"], 16, 4)
+        self.tilemap = Tilemap(self.map_file, self.tileset, TILE_PROPERTIES)
 
+        self.entities = EntityStore()
+        # Every entity animation is sampled from this, so none of them need updating per tick
+        self.animation_clock = AnimationClock()
+
+        # Broadphase for projectile hits
+        self.collisions = SpatialHash(128)
+        # Update level of detail by distance from the player
+        self.scheduler = UpdateScheduler()
+
+        enemy_anims = {"enemy_idle": self.sprites["enemy_idle"]}
+        self.enemies = [Enemy(self.entities, enemy_anims, self.animation_clock, 500, 500)]
+        for e in self.enemies:
+            self.collisions.insert(e, e.rect)
+        self.navigation = FlowField(self.tilemap.solid)
+
+        player_anims = {"walking_animations": self.sprites["player_walk"],
+                        "attack_animation": self.sprites["player_attack"]}
+        self.player = Player(self.entities, player_anims, self.animation_clock, 100, 100)  
+
+        self.camera = Camera(self.screen, self.player)
+        self.projectile_pool = ObjectPool(self.new_projectile)
+
+    def remove_projectile(self, p: Projectile) -> None:
+        p.despawn()
+        self.collisions.remove(p)
+        self.projectile_pool.release(p)
+
+    def new_projectile(self, x, y, direction: str) -> Projectile:
+        p = Projectile(self.entities, {"projectile": self.sprites["projectile"]}, self.animation_clock, x, y)
+        p.set_direction(direction)
+        return p
+
+    def update(self, dt: float) -> None:
+        self.entities.integrate(dt)
+        self.tilemap.resolve_movement(self.player)
+        for e in self.enemies:
+            self.tilemap.resolve_movement(e)
+            self.collisions.update(e, e.rect)
+        active = self.camera.get_active_rect()
+        focus = self.player.rect.center
+
+        # One flow field toward the player serves every enemy. Far enemies re-steer less
+        # often and the farthest are stopped altogether.
+        self.navigation.update(*self.tilemap.cell_at(*focus))
+        for e, _ in self.scheduler.schedule(self.enemies, focus, dt): # Steering needs no elapsed time
+            e.steer(self.navigation, self.tilemap)
+        for e in self.scheduler.suspended:
+            e.stop()
+
+        for animations, name in self.animation_clock.advance(dt):
+            if animations is self.player.animations and name.startswith("attack_"):
+                self.player.finish_attack()
+
+        # Projectiles that hit a wall or leave the active region will never come back
         for p in self.projectiles:
-            p.update(dt)
+            if not active.colliderect(p.rect) or self.tilemap.is_blocked(p.x, p.y, p.w, p.h):
+                self.remove_projectile(p)
+            else:
+                self.collisions.update(p, p.rect)
+
+        for p, e in self.collisions.pairs(self.projectiles, self.enemies):
+            if p.index is None or e.index is None:
+                continue # Already used up by an earlier pair this tick
+            self.remove_projectile(p)
+            if e.hit():
+                e.despawn()
+                self.collisions.remove(e)
+                self.scheduler.remove(e)
+
+        self.projectiles = [p for p in self.projectiles if p.index is not None]
+        self.enemies = [e for e in self.enemies if e.index is not None]
 
         self.camera.update(dt)
+        self.tilemap.update(dt)
+        self.tilemap.stream(self.player.x, self.player.y)
 
-    def render(self) -> None:
+    def render(self, alpha: float) -> None:
         # Clear screen
         self.screen.fill((30, 124, 184))
 
-        for y in self.tilemap.map:
-            for x in y:
-                self.screen.blit(x.sprite, (x.x + self.camera.get_camera_adjustment()[0],
-                                            x.y + self.camera.get_camera_adjustment()[1]))
+        camera_adjust = self.camera.get_camera_adjustment(alpha)
+        view = self.camera.get_view_rect(alpha)
+        visible = view.inflate(self.render_margin * 2, self.render_margin * 2)
+        queue = self.manager.render_queue
 
-        self.enemy.render(self.screen, self.camera.get_camera_adjustment())
-        self.player.render(self.screen, self.camera.get_camera_adjustment())
+        # Drawing happens when the manager flushes the queue, which times each layer
+        self.tilemap.render(queue, view)
 
-        for p in self.projectiles:
-            p.render(self.screen, self.camera.get_camera_adjustment())
+        for e in self.enemies:
+            if visible.colliderect(e.rect):
+                e.render(queue, camera_adjust, alpha)
+        self.player.render(queue, camera_adjust, alpha)
 
-        # Update display
-        pygame.display.update()
+        for p in self.projectiles:
+            if visible.colliderect(p.rect):
+                p.render(queue, camera_adjust, alpha)
 
-    def poll_events(self) -> None:
-        for event in pygame.event.get():
+    def poll_events(self, events: list) -> None:
+        for event in events:
 
             if event.type == pygame.QUIT: # If the user closes the window
                 self.manager.quit_game()         
@@ -479,8 +880,7 @@ class MainScene(Scene):
             # Attack controls
             if event.type == pygame.KEYDOWN and event.key == pygame.K_SPACE:
                 self.player.attack()
-                p = Projectile({"projectile": self.sprites["projectile"]}, self.player.x, self.player.y)
-                p.set_direction(self.player.direction)
+                p = self.projectile_pool.acquire(self.player.x, self.player.y, self.player.direction)
                 self.projectiles.append(p)
 
 
@@ -501,47 +901,32 @@ class MainScene(Scene):
                 self.current_key = None
                 self.player.stop_moving()
 
+# Sprite sheets used by the scenes, loaded on first use
+ASSETS = {"tiles": "gfx/rpg_sprites.png",
+          "enemy_idle": "gfx/enemy_idle.png",
+          "player_walk": "gfx/player_animations.png",
+          "player_attack": "gfx/attack.png",
+          "projectile": "gfx/projectile.png"}
+
 class Game:
-    def __init__(self) -> None:
+    def __init__(self, headless: bool = False, starting_scene: str = "menu") -> None:
         # Initialize global game variables
-        pygame.init() 
-        self.screen = pygame.display.set_mode((1280, 720))
-        self.running = True
-        self.sprites = self.load_sprites()
+        self.screen = init_display((1280, 720), headless)
+        self.sprites = ASSETS
 
         # Scene system
         self.scene_manager = SceneManager()
+        self.scene_manager.render_queue.layer_names = LAYER_NAMES
 
         scenes = {"main": MainScene(self.scene_manager, self.screen, self.sprites),
                   "menu": MenuScene(self.scene_manager, self.screen, self.sprites)}
-        self.scene_manager.initialize(scenes, "menu")
+        self.scene_manager.initialize(scenes, starting_scene)
 
 
-    # MAIN GAME LOOP #
-    def run(self) -> None:
-        self.previous_time = time.time()
-        while self.running:
-
-            self.scene_manager.current_scene.poll_events()
-            self.scene_manager.current_scene.update()
-            self.scene_manager.current_scene.render()
-
-            if self.scene_manager.quit == True:
-                self.running = False    
+    def run(self, frames: int = None, profile_file: str = None) -> None:
+        self.scene_manager.run(frames, profile_file)
 
         pygame.quit()
 
-    # Load sprite textures into pygame as surfaces. 
-    # Returns a dictionary of names to surfaces.
-    def load_sprites(self) -> dict: 
-        sprites = {}
-
-        sprites["enemy_idle"] = pygame.image.load(r"Games\gfx\enemy_idle.png").convert_alpha()
-        sprites["player_walk"] = pygame.image.load(r"Games\gfx\player_animations.png").convert_alpha()
-        sprites["player_attack"] = pygame.image.load(r"Games\gfx\attack.png").convert_alpha()
-        sprites["projectile"] = pygame.image.load(r"Games\gfx\projectile.png").convert_alpha()
-
-        return sprites
-
-g = Game()
-g.run()
\ No newline at end of file
+if __name__ == "__main__":
+    run_from_command_line(Game, "menu")
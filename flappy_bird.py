@@ -1,52 +1,60 @@
 import pygame
 import random
-import time
-from pygame_util import Scene
+import collections
+from pygame_util import SceneManager, Scene, EntityStore, StoreField, ObjectPool, SpatialHash, RenderQueue, TEXT_CACHE, init_display, play_music, run_from_command_line
+import pygame_util
 
+# Render queue layers, back to front
+LAYER_PLAYER = 0
+LAYER_OBSTACLES = 1
+LAYER_HUD = 2
 
-class Entity:
-    def __init__(self, x: float, y: float, velocity: float, sprite: pygame.Surface) -> None:
-        self.x = x
-        self.y = y
+
+# Position and motion live in the scene's EntityStore, which integrates them all at once
+class Entity(pygame_util.Entity):
+    velocity = StoreField("vx")
+
+    def __init__(self, store: EntityStore, x: float, y: float, velocity: float, sprite: pygame.Surface) -> None:
+        super().__init__(store, x, y, sprite.get_width(), sprite.get_height())
         self.velocity = velocity
         self.sprite = sprite
 
-    def update(self, dt) -> None:
-        pass
+    layer = LAYER_OBSTACLES
 
-    def render(self, screen: pygame.Surface) -> None:
-        pass
+    def render(self, queue: RenderQueue, alpha: float) -> None:
+        queue.submit(self.sprite, self.get_render_pos(alpha), self.layer)
+
+    def respawn(self, x: float, y: float, velocity: float) -> None:
+        self.spawn(x, y, self.sprite.get_width(), self.sprite.get_height())
+        self.velocity = velocity
 
 
 class Player(Entity):
+    velocity = StoreField("vy")
+    layer = LAYER_PLAYER
+
     def __init__(self,
+                 store: EntityStore,
                  x: float,
                  y: float,
                  velocity: float,
                  sprite: pygame.Surface,
-                 gravity_constant: float) -> None:
-        super().__init__(x, y, velocity, sprite)
+                 gravity_constant: float,
+                 jump_sound: pygame.mixer.Sound,
+                 death_sound: pygame.mixer.Sound) -> None:
+        super().__init__(store, x, y, velocity, sprite)
         self.gravity_constant = gravity_constant
-        self.rect = self.sprite.get_rect()
+        self.ay = gravity_constant
 
         #sounds
 
-        self.jump_sound = pygame.mixer.Sound(r"Games\sfx\bounce.wav")
-        self.jump_sound.set_volume(0.1)
-        self.death_sound =pygame.mixer.Sound(r"Games\sfx\death.wav")
-        self.death_sound.set_volume(0.5)
-
-    def update(self, dt) -> None:
-        self.y += self.velocity * dt
-        self.velocity += self.gravity_constant * dt
-
-        # update rect
-        self.rect.x = int(self.x)
-        self.rect.y = int(self.y)
+        self.jump_sound = jump_sound
+        self.death_sound = death_sound
 
-
-    def render(self, screen: pygame.Surface) -> None:
-        screen.blit(self.sprite, (self.x, self.y))
+    def reset(self, x: float, y: float, velocity: float) -> None:
+        self.x = self.previous_x = x
+        self.y = self.previous_y = y
+        self.velocity = velocity
 
     def play_jump_sound(self) -> None:
         self.jump_sound.play()
@@ -58,26 +66,10 @@ class Player(Entity):
 class Obstacle(Entity):
 
     class ObstacleBlock(Entity):
-        def __init__(self,
-                     x: float,
-                     y: float,
-                     velocity: float,
-                     sprite: pygame.Surface) -> None:
-
-            super().__init__(x, y, velocity, sprite)
-            self.rect = self.sprite.get_rect()
-
-        def update(self, dt) -> None:
-            self.x += self.velocity * dt
-
-            # Update rect
-            self.rect.x = int(self.x)
-            self.rect.y = int(self.y)
-
-        def render(self, screen: pygame.Surface) -> None:
-            screen.blit(self.sprite, (self.x, self.y))
+        pass
 
     def __init__(self,
+                 store: EntityStore,
                  x: float,
                  y: float,
                  velocity: float,
@@ -86,7 +78,7 @@ class Obstacle(Entity):
                  # Number of blocks from the top of the screen that the gap is located at.
                  gap_loc: int,
                  sprite: pygame.Surface) -> None:
-        super().__init__(x, y, velocity, sprite)
+        super().__init__(store, x, y, velocity, sprite)
         self.screen_height = screen_height
         self.gap_height = gap_height
         self.gap_loc = gap_loc
@@ -102,37 +94,60 @@ class Obstacle(Entity):
 
         self.passed = False
 
-    def create_blocks(self) -> list[ObstacleBlock]:
+    # Called by the obstacle pool to reuse this obstacle and its blocks for a new spawn
+    def reset(self, x: float, y: float, velocity: float, gap_loc: int) -> None:
+        self.respawn(x, y, velocity)
+        self.gap_loc = gap_loc
+        self.gap_range = (self.gap_loc, self.gap_loc + self.gap_height)
+        self.blocks = self.create_blocks(self.blocks)
+        self.passed = False
+
+    # Block handles from a previous spawn are respawned before any new ones are made
+    def create_blocks(self, spare: list = ()) -> list[ObstacleBlock]:
+        spare = list(spare)
         o = []
         current_block = 0
         for i in range(self.num_blocks):
             if i < self.gap_range[0] or i > self.gap_range[1]:
-                o.append(Obstacle.ObstacleBlock(self.x,
-                                                current_block,
-                                                self.velocity,
-                                                self.sprite))
+                if spare:
+                    block = spare.pop()
+                    block.respawn(self.x, current_block, self.velocity)
+                else:
+                    block = Obstacle.ObstacleBlock(self.store,
+                                                   self.x,
+                                                   current_block,
+                                                   self.velocity,
+                                                   self.sprite)
+                o.append(block)
             current_block += self.BLOCK_SIZE
         return o
 
-    def update(self, dt) -> None:
-        self.x += self.velocity * dt
+    # The full-height strip the obstacle's blocks sit in, gap included
+    @property
+    def column(self) -> pygame.Rect:
+        return pygame.Rect(int(self.x), 0, self.BLOCK_SIZE, self.num_blocks * self.BLOCK_SIZE)
+
+    def render(self, queue: RenderQueue, alpha: float) -> None:
         for b in self.blocks:
-            b.update(dt)
+            b.render(queue, alpha)
 
-    def render(self, screen: pygame.Surface) -> None:
+    def despawn(self) -> None:
         for b in self.blocks:
-            b.render(screen)
+            b.despawn()
+        super().despawn()
 
 
 class Environment:
     def __init__(self,
+                 store: EntityStore,
                  player: Player,
                  screen: pygame.Surface,
                  sprites: dict,
-                 freq: int,
+                 freq: float, # Seconds between obstacle spawns
                  obstacle_velocity: float,
                  obstacle_gap: int) -> None:
 
+        self.store = store
         self.obstacle_velocity = obstacle_velocity
         self.obstacle_gap = obstacle_gap
         self.freq = freq
@@ -140,56 +155,79 @@ class Environment:
         self.player = player
         self.sprites = sprites
 
-        self.obstacles = []  # All of the currently active obstacles
+        self.obstacles = collections.deque()  # All of the currently active obstacles, oldest first
+        self.obstacle_pool = ObjectPool(self.new_obstacle, capacity=8)
+        # Obstacle columns, for the player collision check. Hashing one rect per obstacle
+        # rather than every block keeps the per-tick upkeep small.
+        self.collisions = SpatialHash(96)
         self.obstacle_spawn_point = 1280
         self.new_obstacle_timer = 0
 
         self.score_tracker = 0
 
+    def reset(self) -> None:
+        while self.obstacles:
+            self.remove_obstacle()
+        self.new_obstacle_timer = 0
+        self.score_tracker = 0
+
     def add_obstacle(self, obstacle: Obstacle) -> None:
         self.obstacles.append(obstacle)
 
     def remove_obstacle(self) -> None:
-        self.obstacles.pop(0)
-
+        o = self.obstacles.popleft()
+        self.collisions.remove(o)
+        o.despawn()
+        self.obstacle_pool.release(o)
+
+    def new_obstacle(self, x: float, y: float, velocity: float, gap_loc: int) -> Obstacle:
+        return Obstacle(self.store,
+                        x,
+                        y,
+                        velocity,
+                        self.screen.get_height(),
+                        self.obstacle_gap,
+                        gap_loc,
+                        self.sprites["obstacle"])
+
+    # Obstacles have already been moved by the scene's EntityStore
     def update_obstacles(self, dt) -> None:
         for o in self.obstacles:
-            o.update(dt)
-            if o.x < -200:
-                self.remove_obstacle()
-
             if o.x < self.player.x and not o.passed:
                 o.passed = True
                 self.score_tracker += 1
 
+        # Obstacles leave the screen in the order they were spawned
+        while self.obstacles and self.obstacles[0].x < -200:
+            self.remove_obstacle()
+
         if self.new_obstacle_timer > self.freq:  # Time to spawn a new obstacle
 
             gap = random.randint(2, 10)
 
-            o = Obstacle(self.obstacle_spawn_point,
-                         0,
-                         self.obstacle_velocity,
-                         self.screen.get_height(),
-                         self.obstacle_gap,
-                         gap,
-                         self.sprites["obstacle"])
+            o = self.obstacle_pool.acquire(self.obstacle_spawn_point,
+                                           0,
+                                           self.obstacle_velocity,
+                                           gap)
             self.add_obstacle(o)
             self.new_obstacle_timer = 0
 
-        self.new_obstacle_timer += 1
+        for o in self.obstacles:
+            self.collisions.update(o, o.column)
+
+        self.new_obstacle_timer += dt
 
     def update(self, dt) -> None:
         self.update_obstacles(dt)
 
-    def render(self, screen: pygame.Surface) -> None:
+    def render(self, queue: RenderQueue, alpha: float) -> None:
         for o in self.obstacles:
-            o.render(screen)
+            o.render(queue, alpha)
 
 class Score:
     def __init__(self,
                  x,
                  y) -> None:
-        self.font = pygame.font.SysFont("Calibri", 36)
         self.score = 0
         self.text = str(self.score)
         self.x = x
@@ -198,62 +236,50 @@ class Score:
     def add_score(self) -> None:
         self.score += 1
 
-    def update(self) -> None:
+    def reset(self) -> None:
+        self.score = 0
         self.text = str(self.score)
 
-    def render(self, screen: pygame.Surface) -> None:
-        screen.blit(self.font.render(self.text, True, "white"), (self.x, self.y))
-
-
-class SceneManager:
-    def __init__(self) -> None:
-        self.scenes = {}
-        self.quit = False
-
-    def initialize(self, scenes: dict, starting_scene: str) -> None:
-        self.scenes = scenes
-        self.current_scene = self.scenes[starting_scene]
-
-    def set_scene(self, new_scene: str) -> None:
-        self.current_scene = self.scenes[new_scene]
-
-    def get_scene(self):
-        return self.current_scene
-
-    def quit_game(self) -> None:
-        self.quit = True
+    def update(self) -> None:
+        self.text = str(self.score)
 
-    def reset_main(self) -> None:
-        new_scene = MainScene(self,
-                              self.scenes["main"].screen,
-                              self.scenes["main"].sprites)
-        self.scenes["main"] = new_scene
+    def render(self, queue: RenderQueue) -> None:
+        queue.submit(TEXT_CACHE.render(self.text, "Calibri", 36, "white"), (self.x, self.y), LAYER_HUD)
 
 
 class MainScene(Scene):
+    next_scenes = ["death"]
+
     def __init__(self,
                  manager: SceneManager,
                  screen: pygame.Surface,
                  sprites: dict) -> None:
         super().__init__(manager, screen, sprites)
 
-        self.previous_time = None
-
         # GAME CONSTANTS
         self.GRAVITY_CONSTANT = 1700
         self.PLAYER_VEL = 200
         self.JUMP_CONSTANT = -450
-        self.OBS_FREQ = 1600
+        self.OBS_FREQ = 2.0
         self.OBS_VEL = -200
         self.OBS_GAP = 2
 
-        self.player = Player(self.screen.get_width()/2,
+    def load(self) -> None:
+        super().load()
+
+        self.entities = EntityStore()
+
+        self.player = Player(self.entities,
+                             self.screen.get_width()/2,
                              self.screen.get_height()/2,
                              self.PLAYER_VEL,
                              self.sprites["player"],
-                             self.GRAVITY_CONSTANT)
+                             self.GRAVITY_CONSTANT,
+                             self.sprites["jump_sound"],
+                             self.sprites["death_sound"])
 
-        self.env = Environment(self.player,
+        self.env = Environment(self.entities,
+                               self.player,
                                self.screen,
                                self.sprites,
                                self.OBS_FREQ,
@@ -262,16 +288,16 @@ class MainScene(Scene):
 
         self.score = Score(self.screen.get_width()/2, 50)
 
-    def update(self) -> None:
-        if self.previous_time is None:  # First run through the loop
-            self.previous_time = time.time()
-
-        # Delta time
-        now = time.time()
-        dt = now - self.previous_time
-        self.previous_time = now
+    # Restarting reuses the loaded player and sounds
+    def reset(self) -> None:
+        self.player.reset(self.screen.get_width()/2,
+                          self.screen.get_height()/2,
+                          self.PLAYER_VEL)
+        self.env.reset()
+        self.score.reset()
 
-        self.player.update(dt)
+    def update(self, dt: float) -> None:
+        self.entities.integrate(dt)
         self.env.update(dt)
 
         # Check death conditions
@@ -284,19 +310,18 @@ class MainScene(Scene):
         
         self.score.update()
 
-    def render(self) -> None:
+    def render(self, alpha: float) -> None:
         self.screen.fill("black")
 
         self.screen.blit(self.sprites["background"], (0, 0))
 
-        self.player.render(self.screen)
-        self.env.render(self.screen)
-        self.score.render(self.screen)
-
-        pygame.display.update()
+        queue = self.manager.render_queue
+        self.player.render(queue, alpha)
+        self.env.render(queue, alpha)
+        self.score.render(queue)
 
-    def poll_events(self) -> None:
-        for event in pygame.event.get():
+    def poll_events(self, events: list) -> None:
+        for event in events:
             if event.type == pygame.QUIT:
                 self.manager.quit_game()
 
@@ -305,39 +330,42 @@ class MainScene(Scene):
                     self.player.velocity = self.JUMP_CONSTANT
                     self.player.play_jump_sound()
 
+    # Only the blocks of obstacles whose column the player overlaps are tested
     def player_collision(self) -> bool:
-        for o in self.env.obstacles:
+        rect = self.player.rect
+        for o in self.env.collisions.query_rect(rect):
             for b in o.blocks:
-                if b.rect.colliderect(self.player.rect):
+                if b.rect.colliderect(rect):
                     return True
         return False
 
 class StartScene(Scene):
+    next_scenes = ["main"]
+
     def __init__(self,
                  manager: SceneManager,
                  screen: pygame.Surface,
                  sprites: dict) -> None:
         super().__init__(manager, screen, sprites)
 
-        self.font = pygame.font.SysFont("Arial", 36)
         self.text = "Press Space to begin. Press Q to quit."
         self.text_x = 400
         self.text_y = 200
+
+        # Nothing on this screen moves, so it is all baked into the background
+        self.dirty_rects = True
+        self.background = pygame.Surface(self.screen.get_size())
+        self.background.fill("black")
+        self.background.blit(TEXT_CACHE.render(self.text, "Arial", 36, "white"), (self.text_x, self.text_y))
     
-    def update(self) -> None:
+    def update(self, dt: float) -> None:
         pass
 
-    def render(self) -> None:
-        #Clear screen
-        self.screen.fill("black")
-
-        self.screen.blit(self.font.render(self.text, True, "white"), (self.text_x, self.text_y))
-
-        #update the display
-        pygame.display.update()
+    def render(self, alpha: float) -> None:
+        self.begin_frame()
 
-    def poll_events(self) -> None:
-        for event in pygame.event.get():
+    def poll_events(self, events: list) -> None:
+        for event in events:
             if event.type == pygame.QUIT:
                 self.manager.quit_game()
             
@@ -348,6 +376,7 @@ class StartScene(Scene):
                     self.manager.quit_game()
 
 class DeathScene(Scene):
+    next_scenes = ["main"]
 
     def __init__(self,
                 manager: SceneManager, 
@@ -355,74 +384,60 @@ class DeathScene(Scene):
                 sprites: dict) -> None:
         super().__init__(manager, screen, sprites)
 
-        self.font = pygame.font.SysFont("Arial", 36)
         self.text = "You died! Press space to restart. Press Q to quit."
         self.text_x = 400
         self.text_y = 200
+
+        # Nothing on this screen moves, so it is all baked into the background
+        self.dirty_rects = True
+        self.background = pygame.Surface(self.screen.get_size())
+        self.background.fill((59, 3, 3))
+        self.background.blit(TEXT_CACHE.render(self.text, "Arial", 36, "white"), (self.text_x, self.text_y))
     
-    def update(self) -> None:
+    def update(self, dt: float) -> None:
         pass
 
-    def render(self) -> None:
-        #Clear screen
-        self.screen.fill((59, 3, 3))
+    def render(self, alpha: float) -> None:
+        self.begin_frame()
 
-        self.screen.blit(self.font.render(self.text, True, "white"), (self.text_x, self.text_y))
-
-        #update the display
-        pygame.display.update()
-
-    def poll_events(self) -> None:
-        for event in pygame.event.get():
+    def poll_events(self, events: list) -> None:
+        for event in events:
             if event.type == pygame.QUIT:
                 self.manager.quit_game()
             
             if event.type == pygame.KEYDOWN:
                 if event.key == pygame.K_SPACE:
-                    self.manager.reset_main()
+                    self.manager.reset_scene("main")
                     self.manager.set_scene("main")
                 elif event.key == pygame.K_q:
                     self.manager.quit_game()
 
+# Assets used by the scenes, loaded on first use
+ASSETS = {"player": "gfx/ball.png",
+          "obstacle": "gfx/block.png",
+          "background": "gfx/bg.png",
+          "jump_sound": ("sfx/bounce.wav", 0.1),
+          "death_sound": ("sfx/death.wav", 0.5)}
+
 class Game:
-    def __init__(self) -> None:
-        pygame.init()
-        self.running = True
-        self.screen = pygame.display.set_mode((1280, 720))
-        self.sprites = self.load_sprites()
+    def __init__(self, headless: bool = False, starting_scene: str = "start") -> None:
+        self.screen = init_display((1280, 720), headless)
+        self.sprites = ASSETS
 
         self.scene_manager = SceneManager()
         scenes = {"main": MainScene(self.scene_manager, self.screen, self.sprites),
                   "start": StartScene(self.scene_manager,self.screen, self.sprites),
                   "death": DeathScene(self.scene_manager, self.screen, self.sprites)}
-        self.scene_manager.initialize(scenes, "start")
+        self.scene_manager.initialize(scenes, starting_scene)
 
         #play music
-        pygame.mixer.music.load(r"Games\sfx\musicBird.wav")
-        pygame.mixer.music.set_volume(0.1)
-        pygame.mixer.music.play()
-
-    def run(self) -> None:
-        while self.running:
+        play_music("sfx/music.ogg", 0.1)
 
-            self.scene_manager.current_scene.poll_events()
-            self.scene_manager.current_scene.update()
-            self.scene_manager.current_scene.render()
-
-            if self.scene_manager.quit == True:
-                self.running = False
+    def run(self, frames: int = None, profile_file: str = None) -> None:
+        self.scene_manager.run(frames, profile_file)
 
         pygame.quit()
 
-    def load_sprites(self) -> dict:
-        sprites = {}
-
-        sprites["player"] = pygame.image.load(r"Games\gfx\ball.png").convert_alpha()
-        sprites["obstacle"] = pygame.image.load(r"Games\gfx\block.png").convert_alpha()
-        sprites["background"] = pygame.image.load(r"Games\gfx\bg.png").convert_alpha()
-
-        return sprites
-
 
-g = Game()
-g.run()
+if __name__ == "__main__":
+    run_from_command_line(Game, "start")
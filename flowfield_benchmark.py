@@ -0,0 +1,76 @@
+import heapq, os, random, tempfile, time
+import numpy as np
+from pygame_util import TileMapFile
+from RPG_game import CollisionMask, FlowField
+
+# Compares enemy pathing cost per frame: one shared FlowField toward the player versus an
+# A* search per enemy, on a random 256x256 map with 25% walls. The flow field is rebuilt
+# every frame here (the worst case, the player changing tile every frame).
+#   python flowfield_benchmark.py
+
+MAP_SIZE = 256
+RADIUS = 32
+ENEMY_COUNTS = (1, 10, 100, 1000, 10000)
+ASTAR_LIMIT = 100 # A* gets too slow to bother measuring past this many enemies
+FRAMES = 20
+
+def build_mask(directory: str) -> CollisionMask:
+    rng = np.random.default_rng(1)
+    tiles = (rng.random((MAP_SIZE, MAP_SIZE)) < 0.25).astype(np.uint16)
+    filename = os.path.join(directory, "benchmark.tmap")
+    TileMapFile.save(filename, tiles)
+    return CollisionMask(TileMapFile(filename), [1])
+
+# A* over the same 4-connected grid and window the flow field searches
+def astar(solid: np.ndarray, start: tuple, goal: tuple) -> int:
+    left, top = goal[0] - RADIUS, goal[1] - RADIUS
+    costs = {start: 0}
+    queue = [(0, start)]
+    while queue:
+        _, cell = heapq.heappop(queue)
+        if cell == goal:
+            return costs[cell]
+        for dx, dy in ((1, 0), (-1, 0), (0, 1), (0, -1)):
+            n = (cell[0] + dx, cell[1] + dy)
+            x, y = n[0] - left, n[1] - top
+            if not (0 <= x <= RADIUS * 2 and 0 <= y <= RADIUS * 2) or solid[y, x]:
+                continue
+            cost = costs[cell] + 1
+            if cost < costs.get(n, 1 << 30):
+                costs[n] = cost
+                heapq.heappush(queue, (cost + abs(n[0] - goal[0]) + abs(n[1] - goal[1]), n))
+    return -1
+
+def main() -> None:
+    random.seed(1)
+    with tempfile.TemporaryDirectory() as directory:
+        mask = build_mask(directory)
+        goal = (MAP_SIZE // 2, MAP_SIZE // 2)
+        field = FlowField(mask, RADIUS)
+
+        print(f"{'enemies':>8} {'flow field ms/frame':>20} {'A* ms/frame':>12}")
+        for count in ENEMY_COUNTS:
+            enemies = [(goal[0] + random.randint(-RADIUS, RADIUS), goal[1] + random.randint(-RADIUS, RADIUS))
+                       for _ in range(count)]
+
+            start = time.perf_counter()
+            for frame in range(FRAMES):
+                field.update(goal[0] + frame % 2, goal[1]) # A new goal cell forces a rebuild
+                for x, y in enemies:
+                    field.get_direction(x, y)
+            field_ms = (time.perf_counter() - start) * 1000 / FRAMES
+
+            astar_ms = "-"
+            if count <= ASTAR_LIMIT:
+                start = time.perf_counter()
+                for frame in range(FRAMES):
+                    target = (goal[0] + frame % 2, goal[1])
+                    solid = mask.region(target[0] - RADIUS, target[1] - RADIUS, RADIUS * 2 + 1, RADIUS * 2 + 1)
+                    for enemy in enemies:
+                        astar(solid, enemy, target)
+                astar_ms = f"{(time.perf_counter() - start) * 1000 / FRAMES:.2f}"
+
+            print(f"{count:>8} {field_ms:>20.2f} {astar_ms:>12}")
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,120 @@
-import pygame, time, random
+import pygame, time, random, os, argparse
+import numpy as np
+import collections, collections.abc, contextlib, csv, io, json, hashlib, struct
+import threading, concurrent.futures, gzip, weakref
 
+# Positions, velocities, accelerations and bounding boxes of every moving object in a
+# scene, kept in contiguous NumPy arrays (one array per field, one slot per entity) so
+# motion for all of them is integrated in a single vectorized step. Freed slots are reused.
+class EntityStore:
+    FIELDS = ("x", "y", "vx", "vy", "ax", "ay", "w", "h", "previous_x", "previous_y")
+
+    def __init__(self, capacity: int = 64) -> None:
+        self.capacity = capacity
+        self.size = 0 # Slots in use or freed, everything past this is untouched
+        self.free = []
+        self.alive = np.zeros(capacity, dtype=bool)
+        for field in self.FIELDS:
+            setattr(self, field, np.zeros(capacity))
+
+    def add(self, x: float, y: float, w: float = 0, h: float = 0,
+            vx: float = 0, vy: float = 0, ax: float = 0, ay: float = 0) -> int:
+        if self.free:
+            index = self.free.pop()
+        else:
+            if self.size == self.capacity:
+                self.grow()
+            index = self.size
+            self.size += 1
+
+        self.alive[index] = True
+        self.x[index] = self.previous_x[index] = x
+        self.y[index] = self.previous_y[index] = y
+        self.w[index] = w
+        self.h[index] = h
+        self.vx[index] = vx
+        self.vy[index] = vy
+        self.ax[index] = ax
+        self.ay[index] = ay
+        return index
+
+    # Dead slots keep zero velocity and acceleration, so integrate() can skip masking
+    def remove(self, index: int) -> None:
+        self.alive[index] = False
+        for field in self.FIELDS:
+            getattr(self, field)[index] = 0
+        self.free.append(index)
+
+    def grow(self) -> None:
+        self.capacity *= 2
+        self.alive = np.concatenate((self.alive, np.zeros(self.capacity - len(self.alive), dtype=bool)))
+        for field in self.FIELDS:
+            array = getattr(self, field)
+            setattr(self, field, np.concatenate((array, np.zeros(self.capacity - len(array)))))
+
+    # Position first, then velocity, matching the per-object updates this replaced
+    def integrate(self, dt: float) -> None:
+        n = self.size
+        self.previous_x[:n] = self.x[:n]
+        self.previous_y[:n] = self.y[:n]
+        self.x[:n] += self.vx[:n] * dt
+        self.y[:n] += self.vy[:n] * dt
+        self.vx[:n] += self.ax[:n] * dt
+        self.vy[:n] += self.ay[:n] * dt
+
+    def __len__(self) -> int:
+        return self.size - len(self.free)
+
+# Reads and writes one field of an entity's slot in its EntityStore
+class StoreField:
+    def __init__(self, field: str) -> None:
+        self.field = field
+
+    def __get__(self, entity, owner=None):
+        if entity is None:
+            return self
+        return getattr(entity.store, self.field)[entity.index].item()
+
+    def __set__(self, entity, value: float) -> None:
+        getattr(entity.store, self.field)[entity.index] = value
+
+# A thin handle into an EntityStore. Subclasses keep their sprites and game logic here,
+# while position and motion live in the store and are integrated by the scene.
 class Entity:
-    def __init__(self) -> None:
-        pass
+    x = StoreField("x")
+    y = StoreField("y")
+    vx = StoreField("vx")
+    vy = StoreField("vy")
+    ax = StoreField("ax")
+    ay = StoreField("ay")
+    w = StoreField("w")
+    h = StoreField("h")
+    previous_x = StoreField("previous_x")
+    previous_y = StoreField("previous_y")
+
+    def __init__(self, store: EntityStore, x: float, y: float, w: float = 0, h: float = 0) -> None:
+        self.store = store
+        self.index = None
+        self.spawn(x, y, w, h)
+
+    # Takes a fresh slot in the store, e.g. when a pooled entity is reused after despawn()
+    def spawn(self, x: float, y: float, w: float = 0, h: float = 0) -> None:
+        if self.index is not None:
+            self.store.remove(self.index)
+        self.index = self.store.add(x, y, w, h)
+
+    @property
+    def rect(self) -> pygame.Rect:
+        return pygame.Rect(int(self.x), int(self.y), int(self.w), int(self.h))
+
+    # Position interpolated between the last two ticks
+    def get_render_pos(self, alpha: float) -> tuple:
+        return (lerp(self.previous_x, self.x, alpha), lerp(self.previous_y, self.y, alpha))
+
+    def despawn(self) -> None:
+        if self.index is not None:
+            self.store.remove(self.index)
+            self.index = None
 
     def update(self, dt) -> None:
         pass
@@ -10,42 +122,1310 @@ class Entity:
     def render(self, screen: pygame.Surface) -> None:
         pass
 
-# Handles switching between scenes
-class SceneManager:
+# Recycles short-lived objects such as projectiles. acquire(*args) hands back a released
+# object re-initialized with its reset(*args) (a hit), or builds one with factory(*args)
+# (a miss). Released objects are kept for reuse until `capacity` of them are waiting.
+# Releasing an object that isn't currently handed out raises, since a double release would
+# give the same object to two owners.
+class ObjectPool:
+    def __init__(self, factory, capacity: int = 64) -> None:
+        self.factory = factory
+        self.capacity = capacity
+        self.free = []
+        self.in_use = set() # id() of every object handed out and not yet released
+        self.live = 0
+        self.hits = 0
+        self.misses = 0
+        self.peak_live = 0
+
+    def acquire(self, *args, **kwargs):
+        if self.free:
+            obj = self.free.pop()
+            obj.reset(*args, **kwargs)
+            self.hits += 1
+        else:
+            obj = self.factory(*args, **kwargs)
+            self.misses += 1
+
+        self.in_use.add(id(obj))
+        self.live += 1
+        self.peak_live = max(self.peak_live, self.live)
+        return obj
+
+    def release(self, obj) -> None:
+        if id(obj) not in self.in_use:
+            raise ValueError(f"{obj!r} is not in use; released twice or not from this pool")
+        self.in_use.remove(id(obj))
+        self.live -= 1
+        if len(self.free) < self.capacity:
+            self.free.append(obj)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "live": self.live,
+                "peak_live": self.peak_live,
+                "free": len(self.free)}
+
+# Uniform-grid broadphase. Objects are bucketed by the cells their rect touches, so a
+# query only looks at objects in nearby cells. update() re-buckets an object only when
+# it has crossed into different cells, so keeping moving objects current stays cheap.
+# Cells are insertion-ordered dicts rather than sets, so queries return objects in an
+# order that doesn't depend on memory addresses and replays stay deterministic.
+class SpatialHash:
+    def __init__(self, cell_size: int = 128) -> None:
+        self.cell_size = cell_size
+        self.cells = collections.defaultdict(dict) # (cell_x, cell_y) -> {object: None}
+        self.rects = {} # object -> rect
+        self.keys = {} # object -> cells it is bucketed in
+
+    def cells_for(self, rect: pygame.Rect) -> tuple:
+        size = self.cell_size
+        return tuple((x, y) for y in range(rect.top // size, (rect.bottom - 1) // size + 1)
+                            for x in range(rect.left // size, (rect.right - 1) // size + 1))
+
+    def insert(self, obj, rect: pygame.Rect) -> None:
+        self.rects[obj] = pygame.Rect(rect)
+        keys = self.keys[obj] = self.cells_for(rect)
+        for key in keys:
+            self.cells[key][obj] = None
+
+    def update(self, obj, rect: pygame.Rect) -> None:
+        if obj not in self.rects:
+            self.insert(obj, rect)
+            return
+        self.rects[obj] = pygame.Rect(rect)
+        keys = self.cells_for(rect)
+        if keys != self.keys[obj]:
+            self.unlink(obj)
+            self.keys[obj] = keys
+            for key in keys:
+                self.cells[key][obj] = None
+
+    def remove(self, obj) -> None:
+        if obj in self.rects:
+            self.unlink(obj)
+            del self.rects[obj]
+            del self.keys[obj]
+
+    def unlink(self, obj) -> None:
+        for key in self.keys[obj]:
+            cell = self.cells[key]
+            cell.pop(obj, None)
+            if not cell:
+                del self.cells[key]
+
+    # Everything in the cells a rect touches, in insertion order, before any exact overlap test
+    def candidates(self, rect: pygame.Rect) -> dict:
+        found = {}
+        for key in self.cells_for(rect):
+            found.update(self.cells.get(key, {}))
+        return found
+
+    def query_rect(self, rect: pygame.Rect) -> list:
+        return [obj for obj in self.candidates(rect) if self.rects[obj].colliderect(rect)]
+
+    def query_point(self, x: float, y: float) -> list:
+        cell = self.cells.get((int(x // self.cell_size), int(y // self.cell_size)), ())
+        return [obj for obj in cell if self.rects[obj].collidepoint(x, y)]
+
+    # Objects whose rect comes within radius of a point
+    def query_radius(self, x: float, y: float, radius: float) -> list:
+        found = []
+        bounds = pygame.Rect(int(x - radius), int(y - radius), int(radius * 2) + 2, int(radius * 2) + 2)
+        for obj in self.candidates(bounds):
+            rect = self.rects[obj]
+            dx = x - max(rect.left, min(x, rect.right))
+            dy = y - max(rect.top, min(y, rect.bottom))
+            if dx * dx + dy * dy <= radius * radius:
+                found.append(obj)
+        return found
+
+    # Overlapping (a, b) pairs with a from group and b from others, or every overlapping
+    # pair within group (each reported once) when others is None
+    def pairs(self, group, others=None) -> list:
+        group = list(group)
+        targets = set(group) if others is None else set(others)
+        done = set()
+        found = []
+        for a in group:
+            if a not in self.rects:
+                continue
+            for b in self.query_rect(self.rects[a]):
+                if b is not a and b in targets and b not in done:
+                    found.append((a, b))
+            if others is None:
+                done.add(a)
+        return found
+
+# Level of detail for entity updates. Each (radius, interval) band ticks the entities whose
+# centre is within that distance of a focus point once every `interval` frames, staggered
+# so the work is spread evenly. Entities past the last band are suspended. A skipped
+# entity's dt accumulates, so when it does tick it is handed all the time it missed.
+class UpdateScheduler:
+    def __init__(self, bands: tuple = ((800, 1), (1600, 4), (3200, 12))) -> None:
+        self.bands = [(radius * radius, interval) for radius, interval in bands]
+        self.frame = 0
+        self.pending = {} # entity -> dt accumulated since its last tick
+        self.phases = {} # entity -> stagger offset, handed out in order so replays match
+        self.next_phase = 0
+        self.suspended = [] # Entities past the last band on the latest schedule() call
+
+    # The (entity, accumulated dt) pairs due to tick this frame
+    def schedule(self, entities, focus: tuple, dt: float) -> list:
+        due = []
+        self.suspended = []
+        for entity in entities:
+            x, y = entity.rect.center
+            distance = (x - focus[0]) ** 2 + (y - focus[1]) ** 2
+            interval = None
+            for radius, band_interval in self.bands:
+                if distance <= radius:
+                    interval = band_interval
+                    break
+
+            if interval is None:
+                self.pending[entity] = 0
+                self.suspended.append(entity)
+                continue
+
+            elapsed = self.pending.get(entity, 0) + dt
+            if entity not in self.phases:
+                self.phases[entity] = self.next_phase
+                self.next_phase += 1
+            if (self.frame + self.phases[entity]) % interval == 0:
+                due.append((entity, elapsed))
+                elapsed = 0
+            self.pending[entity] = elapsed
+
+        self.frame += 1
+        return due
+
+    # Forgets an entity that has been removed (or released to a pool)
+    def remove(self, entity) -> None:
+        self.pending.pop(entity, None)
+        self.phases.pop(entity, None)
+
+# Linear interpolation between the last two simulation states, used by render(alpha)
+def lerp(previous: float, current: float, alpha: float) -> float:
+    return previous + (current - previous) * alpha
+
+# Assets are addressed by portable keys such as "gfx/ball.png", relative to this directory
+ASSET_ROOT = os.path.dirname(os.path.abspath(__file__))
+ASSET_CACHE_DIR = os.path.join(ASSET_ROOT, ".asset_cache")
+SOUND_EXTENSIONS = (".wav", ".ogg", ".mp3")
+
+def asset_path(name: str) -> str:
+    return os.path.join(ASSET_ROOT, *name.split("/"))
+
+# Headless mode runs the games on SDL's dummy video and audio drivers, so scenes can be
+# simulated with no window or sound device (CI boxes, soak tests, bots).
+HEADLESS = False
+
+# Initializes pygame and opens the game window, or a dummy display when headless.
+# Must be called before anything else touches pygame.
+def init_display(size: tuple, headless: bool = False) -> pygame.Surface:
+    global HEADLESS
+    HEADLESS = headless
+    if headless:
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
+        os.environ["SDL_AUDIODRIVER"] = "dummy"
+
+    pygame.init()
+    return pygame.display.set_mode(size)
+
+# Recording and replaying need every run to draw the same random numbers and switch
+# scenes on the same frames, so they seed the global RNG and turn off background loading.
+# Must be called before the game builds its scenes.
+DETERMINISTIC = False
+
+def make_deterministic(seed: int) -> None:
+    global DETERMINISTIC
+    DETERMINISTIC = True
+    random.seed(seed)
+
+# Stand-in for pygame.mixer.Sound when there is no audio device
+class SilentSound:
+    def play(self, *args, **kwargs) -> None:
+        pass
+
+    def stop(self) -> None:
+        pass
+
+    def set_volume(self, volume: float) -> None:
+        pass
+
+def load_sound(name: str, volume: float = 1.0):
+    if HEADLESS or pygame.mixer.get_init() is None:
+        return SilentSound()
+    sound = pygame.mixer.Sound(asset_path(name))
+    sound.set_volume(volume)
+    return sound
+
+def play_music(name: str, volume: float = 1.0) -> None:
+    if HEADLESS or pygame.mixer.get_init() is None:
+        return
+    pygame.mixer.music.load(asset_path(name))
+    pygame.mixer.music.set_volume(volume)
+    pygame.mixer.music.play()
+
+# Command line options shared by all the games
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--headless", action="store_true",
+                        help="run without a window or audio, as fast as possible")
+    parser.add_argument("--frames", type=int, default=None,
+                        help="stop after this many frames")
+    parser.add_argument("--scene", default=None,
+                        help="name of the scene to start in")
+    parser.add_argument("--profile", default=None, metavar="FILE",
+                        help="write the frame profile to FILE (.csv or .json) on exit")
+    parser.add_argument("--record", default=None, metavar="FILE",
+                        help="record input, frame times and the RNG seed to FILE")
+    parser.add_argument("--replay", default=None, metavar="FILE",
+                        help="replay a recording, headless unless --realtime is given")
+    parser.add_argument("--realtime", action="store_true",
+                        help="play a replay in a window at its recorded speed")
+    return parser.parse_args()
+
+# Entry point shared by the games. game_class is built as game_class(headless, scene).
+def run_from_command_line(game_class, default_scene: str) -> None:
+    args = parse_args()
+
+    if args.replay is not None:
+        recording = InputRecording.load(args.replay)
+        make_deterministic(recording.seed)
+        game = game_class(args.headless or not args.realtime, recording.scene)
+        game.scene_manager.play(recording, args.realtime, args.frames, args.profile)
+        pygame.quit()
+        return
+
+    scene = args.scene or default_scene
+    recording = None
+    if args.record is not None:
+        recording = InputRecording(random.randrange(2**32), scene)
+        make_deterministic(recording.seed)
+
+    game = game_class(args.headless, scene)
+    game.scene_manager.recording = recording
+    game.run(args.frames, args.profile)
+
+    if recording is not None:
+        recording.save(args.record)
+
+# A recorded session: the RNG seed, the starting scene, and for every frame the frame
+# time and the events the SceneManager received. Since the simulation runs in fixed ticks,
+# feeding the same frames back in reproduces the session exactly.
+# Saved as a gzipped stream of little-endian structs with each event's attributes as JSON.
+class InputRecording:
+    MAGIC = b"RPLY"
+    VERSION = 1
+    HEADER = "<4sHQ"
+    FRAME = "<dH"
+    EVENT = "<IH"
+
+    def __init__(self, seed: int, scene: str) -> None:
+        self.seed = seed
+        self.scene = scene
+        self.frames = [] # (frame_time, [(event type, attribute dict), ...])
+
+    def record(self, frame_time: float, events: list) -> None:
+        self.frames.append((frame_time, [(e.type, event_attributes(e)) for e in events]))
+
+    # The events of each frame rebuilt as pygame events
+    def get_frame(self, index: int) -> tuple:
+        frame_time, events = self.frames[index]
+        return frame_time, [pygame.event.Event(t, attributes) for t, attributes in events]
+
+    def save(self, filename: str) -> None:
+        with gzip.open(filename, "wb") as f:
+            f.write(struct.pack(self.HEADER, self.MAGIC, self.VERSION, self.seed))
+            write_string(f, self.scene)
+            for frame_time, events in self.frames:
+                f.write(struct.pack(self.FRAME, frame_time, len(events)))
+                for event_type, attributes in events:
+                    data = json.dumps(attributes, separators=(",", ":")).encode()
+                    f.write(struct.pack(self.EVENT, event_type, len(data)))
+                    f.write(data)
+
+    @classmethod
+    def load(cls, filename: str) -> "InputRecording":
+        with gzip.open(filename, "rb") as f:
+            data = f.read()
+
+        magic, version, seed = struct.unpack_from(cls.HEADER, data)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            raise ValueError(f"{filename} is not a version {cls.VERSION} recording")
+        offset = struct.calcsize(cls.HEADER)
+        scene, offset = read_string(data, offset)
+        recording = cls(seed, scene)
+
+        frame_size = struct.calcsize(cls.FRAME)
+        event_size = struct.calcsize(cls.EVENT)
+        while offset < len(data):
+            frame_time, count = struct.unpack_from(cls.FRAME, data, offset)
+            offset += frame_size
+            events = []
+            for _ in range(count):
+                event_type, length = struct.unpack_from(cls.EVENT, data, offset)
+                offset += event_size
+                attributes = json.loads(data[offset:offset + length])
+                offset += length
+                # JSON turns tuples such as pos and rel into lists
+                events.append((event_type, {k: tuple(v) if isinstance(v, list) else v
+                                            for k, v in attributes.items()}))
+            recording.frames.append((frame_time, events))
+        return recording
+
+# The attributes of an event that can be written out (drops e.g. window handles)
+def event_attributes(event: pygame.event.Event) -> dict:
+    attributes = {}
+    for name, value in event.dict.items():
+        if isinstance(value, (bool, int, float, str)) or value is None:
+            attributes[name] = value
+        elif isinstance(value, tuple) and all(isinstance(v, (int, float)) for v in value):
+            attributes[name] = value
+    return attributes
+
+def write_string(f, text: str) -> None:
+    data = text.encode()
+    f.write(struct.pack("<H", len(data)))
+    f.write(data)
+
+def read_string(data: bytes, offset: int) -> tuple:
+    length, = struct.unpack_from("<H", data, offset)
+    offset += 2
+    return data[offset:offset + length].decode(), offset + length
+
+# Tile maps on disk: a small header, then every layer as little-endian uint16 tile ids
+# stored chunk by chunk, so each chunk is one contiguous run of the file. The file is
+# memory-mapped and only the chunks that are actually read get paged in, so a
+# 10,000 x 10,000 map opens instantly and costs RAM only for the parts in use.
+class TileMapFile:
+    MAGIC = b"TMAP"
+    VERSION = 1
+    HEADER = "<4sHIIHH"
+    EMPTY = 0xFFFF # Cells with no tile, including the padding of edge chunks
+
+    def __init__(self, filename: str) -> None:
+        header_size = struct.calcsize(self.HEADER)
+        with open(filename, "rb") as f:
+            header = f.read(header_size)
+        self.width, self.height, self.chunk_size, self.layer_count = self.read_header(header, filename)
+
+        self.filename = filename
+        self.chunks_x = -(-self.width // self.chunk_size)
+        self.chunks_y = -(-self.height // self.chunk_size)
+        # Copy-on-write, so set_tile edits stay in memory and never reach the file
+        self.chunks = np.memmap(filename, dtype="<u2", mode="c", offset=header_size,
+                                shape=(self.layer_count, self.chunks_y, self.chunks_x,
+                                       self.chunk_size, self.chunk_size))
+
+    # (width, height, chunk_size, layer_count) from the start of a map file
+    @classmethod
+    def read_header(cls, data: bytes, filename: str) -> tuple:
+        if len(data) < struct.calcsize(cls.HEADER):
+            raise ValueError(f"{filename} is not a version {cls.VERSION} tile map")
+        magic, version, width, height, chunk_size, layer_count = struct.unpack_from(cls.HEADER, data)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            raise ValueError(f"{filename} is not a version {cls.VERSION} tile map")
+        return width, height, chunk_size, layer_count
+
+    # Reads a whole map into a (layers, height, width) array with one frombuffer call, for
+    # tools and maps small enough that streaming isn't worth it
+    @classmethod
+    def read(cls, filename: str) -> np.ndarray:
+        with open(filename, "rb") as f:
+            data = f.read()
+        width, height, chunk_size, layer_count = cls.read_header(data, filename)
+        chunks_x = -(-width // chunk_size)
+        chunks_y = -(-height // chunk_size)
+        chunks = np.frombuffer(data, dtype="<u2", offset=struct.calcsize(cls.HEADER),
+                               count=layer_count * chunks_y * chunks_x * chunk_size * chunk_size)
+        chunks = chunks.reshape(layer_count, chunks_y, chunks_x, chunk_size, chunk_size)
+        return chunks.swapaxes(2, 3).reshape(layer_count, chunks_y * chunk_size, chunks_x * chunk_size)[:, :height, :width]
+
+    # A (layers, chunk_size, chunk_size) view of one chunk
+    def get_chunk(self, chunk_x: int, chunk_y: int) -> np.ndarray:
+        return self.chunks[:, chunk_y, chunk_x]
+
+    def get_tile(self, x: int, y: int, layer: int = 0) -> int:
+        size = self.chunk_size
+        return int(self.chunks[layer, y // size, x // size, y % size, x % size])
+
+    def set_tile(self, x: int, y: int, tile_id: int, layer: int = 0) -> None:
+        size = self.chunk_size
+        self.chunks[layer, y // size, x // size, y % size, x % size] = tile_id
+
+    # For each chunk overlapping a block of cells (clipped to the map), yields its key,
+    # the overlap's slices relative to the block and the same cells inside the chunk
+    def chunk_overlaps(self, left: int, top: int, width: int, height: int):
+        size = self.chunk_size
+        x0, y0 = max(left, 0), max(top, 0)
+        x1, y1 = min(left + width, self.width), min(top + height, self.height)
+        if x0 >= x1 or y0 >= y1:
+            return
+        for chunk_y in range(y0 // size, (y1 - 1) // size + 1):
+            for chunk_x in range(x0 // size, (x1 - 1) // size + 1):
+                cx0, cx1 = max(x0, chunk_x * size), min(x1, (chunk_x + 1) * size)
+                cy0, cy1 = max(y0, chunk_y * size), min(y1, (chunk_y + 1) * size)
+                yield ((chunk_x, chunk_y),
+                       (slice(cy0 - top, cy1 - top), slice(cx0 - left, cx1 - left)),
+                       (slice(cy0 - chunk_y * size, cy1 - chunk_y * size), slice(cx0 - chunk_x * size, cx1 - chunk_x * size)))
+
+    # A (height, width) copy of a block of cells, EMPTY wherever it runs off the map
+    def get_region(self, left: int, top: int, width: int, height: int, layer: int = 0) -> np.ndarray:
+        region = np.full((height, width), self.EMPTY, dtype=np.uint16)
+        for (chunk_x, chunk_y), cells, chunk_cells in self.chunk_overlaps(left, top, width, height):
+            region[cells] = self.chunks[layer, chunk_y, chunk_x][chunk_cells]
+        return region
+
+    # Writes a (height, width) block of tile ids and returns the keys of the chunks it touched
+    def set_region(self, left: int, top: int, tile_ids, layer: int = 0) -> list:
+        tile_ids = np.asarray(tile_ids, dtype=np.uint16)
+        touched = []
+        for key, cells, chunk_cells in self.chunk_overlaps(left, top, tile_ids.shape[1], tile_ids.shape[0]):
+            self.chunks[layer, key[1], key[0]][chunk_cells] = tile_ids[cells]
+            touched.append(key)
+        return touched
+
+    # (x, y) cell coordinates of every tile with the given id, as an (n, 2) array
+    def find_tiles(self, tile_id: int, layer: int = 0) -> np.ndarray:
+        chunk_y, chunk_x, row, column = np.nonzero(self.chunks[layer] == tile_id)
+        return np.column_stack((chunk_x * self.chunk_size + column, chunk_y * self.chunk_size + row))
+
+    # Writes a (height, width) grid or a (layers, height, width) stack of tile ids
+    @classmethod
+    def save(cls, filename: str, layers, chunk_size: int = 16) -> None:
+        layers = np.asarray(layers, dtype="<u2")
+        if layers.ndim == 2:
+            layers = layers[np.newaxis]
+        layer_count, height, width = layers.shape
+        chunks_x = -(-width // chunk_size)
+        chunks_y = -(-height // chunk_size)
+
+        padded = np.full((layer_count, chunks_y * chunk_size, chunks_x * chunk_size), cls.EMPTY, dtype="<u2")
+        padded[:, :height, :width] = layers
+        # (layers, rows, columns) -> (layers, chunk rows, chunk columns, rows, columns)
+        chunked = padded.reshape(layer_count, chunks_y, chunk_size, chunks_x, chunk_size).swapaxes(2, 3)
+
+        temp_file = filename + ".tmp"
+        with open(temp_file, "wb") as f:
+            f.write(struct.pack(cls.HEADER, cls.MAGIC, cls.VERSION, width, height, chunk_size, layer_count))
+            f.write(np.ascontiguousarray(chunked).tobytes())
+        os.replace(temp_file, filename)
+
+# Per-frame timings for each phase of the main loop (events, update, render, present), for
+# each render queue layer, and for any named section a scene opens with
+# `with manager.profiler.section("pathing"):`.
+# The last `size` frames are kept in a ring buffer. Times are stored in milliseconds.
+class Profiler:
+    OVERLAY_KEY = pygame.K_F3
+    DUMP_KEY = pygame.K_F4
+
+    def __init__(self, size: int = 600, overlay_refresh: int = 30) -> None:
+        self.samples = collections.deque(maxlen=size)
+        self.current = {}
+        self.names = ["events", "update", "render", "present"] # Plus sections, in first-seen order
+        self.counters = [] # Names recorded with count(), listed apart from the timings
+
+        self.show_overlay = False
+        self.overlay_refresh = overlay_refresh # Frames between overlay stat updates
+        self.overlay_lines = []
+        self.frames_since_refresh = overlay_refresh
+        self.font = None
+
+    def begin_frame(self) -> None:
+        self.current = {}
+
+    def end_frame(self) -> None:
+        self.samples.append(self.current)
+
+    @contextlib.contextmanager
+    def section(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, (time.perf_counter() - start) * 1000)
+
+    # Per-frame tallies such as draw calls, kept alongside the timings
+    def count(self, name: str, value: int) -> None:
+        if name not in self.counters:
+            self.counters.append(name)
+        self.add(name, value)
+
+    def add(self, name: str, ms: float) -> None:
+        if name not in self.current and name not in self.names:
+            self.names.append(name)
+        self.current[name] = self.current.get(name, 0.0) + ms
+
+    # Returns {name: (mean, p95, p99)} over the frames in the buffer that recorded the name
+    def stats(self) -> dict:
+        stats = {}
+        for name in self.names:
+            values = sorted(s[name] for s in self.samples if name in s)
+            if not values:
+                continue
+            stats[name] = (sum(values) / len(values),
+                           percentile(values, 95),
+                           percentile(values, 99))
+        return stats
+
+    # Writes the ring buffer to disk, as JSON if the filename ends in .json, otherwise CSV
+    def dump(self, filename: str) -> None:
+        if filename.endswith(".json"):
+            with open(filename, "w") as f:
+                json.dump({"names": self.names,
+                           "frames": list(self.samples),
+                           "summary": {name: {"mean": s[0], "p95": s[1], "p99": s[2]}
+                                       for name, s in self.stats().items()}}, f, indent=1)
+        else:
+            with open(filename, "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(["frame"] + self.names)
+                for i, s in enumerate(self.samples):
+                    writer.writerow([i] + [round(s.get(name, 0.0), 4) for name in self.names])
+
+    def toggle_overlay(self) -> None:
+        self.show_overlay = not self.show_overlay
+        self.frames_since_refresh = self.overlay_refresh
+
+    # Draws the stats table in the top left corner and returns the area it covered
+    def render_overlay(self, screen: pygame.Surface) -> pygame.Rect:
+        if self.font is None:
+            self.font = pygame.font.SysFont("Consolas", 16)
+
+        # Sorting the whole buffer every frame would show up in the profile itself
+        self.frames_since_refresh += 1
+        if self.frames_since_refresh >= self.overlay_refresh:
+            self.frames_since_refresh = 0
+            stats = self.stats()
+            self.overlay_lines = [f"{'ms':<12}{'mean':>7}{'p95':>7}{'p99':>7}"]
+            for name, (mean, p95, p99) in stats.items():
+                if name not in self.counters:
+                    self.overlay_lines.append(f"{name:<12}{mean:7.2f}{p95:7.2f}{p99:7.2f}")
+            if any(name in stats for name in self.counters):
+                self.overlay_lines.append(f"{'count':<12}{'mean':>7}{'p95':>7}{'p99':>7}")
+                for name in self.counters:
+                    if name in stats:
+                        mean, p95, p99 = stats[name]
+                        self.overlay_lines.append(f"{name:<12}{mean:7.1f}{p95:7.0f}{p99:7.0f}")
+            self.overlay_lines = [self.font.render(line, True, "white", "black")
+                                  for line in self.overlay_lines]
+
+        area = pygame.Rect(0, 0, 0, 0)
+        y = 0
+        for line in self.overlay_lines:
+            area.union_ip(screen.blit(line, (0, y)))
+            y += line.get_height()
+        return area
+
+# Nearest-rank percentile of an already sorted list
+def percentile(values: list, p: float) -> float:
+    index = max(0, min(len(values) - 1, int(round(p / 100 * len(values))) - 1))
+    return values[index]
+
+# Loads images and sounds on first use and hands out one shared copy per key.
+# Every load is made on behalf of an owner (normally a Scene); an asset is dropped once
+# all of its owners have been released. Images that have been decoded, scaled and
+# converted once are written to an on-disk cache as raw pixels in the display's format,
+# so later startups skip PNG decoding, transform.scale and convert_alpha and just wrap
+# the file contents with frombuffer. The contents are read into a bytearray the surface
+# owns, never an immutable bytes object. Cache entries are keyed on the source file's size
+# and mtime. prefetch() only reads files, so it is safe on a worker thread; the surfaces
+# are made from what it read when the image is first asked for, on the main thread.
+class AssetManager:
+    def __init__(self, cache_dir: str = ASSET_CACHE_DIR) -> None:
+        self.cache_dir = cache_dir
+        self.assets = {} # asset key -> surface or sound
+        self.refcounts = {} # asset key -> number of owners holding it
+        self.owned = {} # owner -> set of asset keys
+        self.prefetched = {} # image key -> (cache file contents, source file contents)
+        self.lock = threading.RLock() # prefetch() runs on the loader thread
+
+    # size is either a (w, h) tuple or an integer scale factor
+    def image(self, name: str, size=None, owner=None) -> pygame.Surface:
+        key = ("image", name, size)
+        with self.lock:
+            if key not in self.assets:
+                self.assets[key] = self.load_image(name, size)
+            self.acquire(owner, key)
+            return self.assets[key]
+
+    def sound(self, name: str, volume: float = 1.0, owner=None):
+        key = ("sound", name, volume)
+        with self.lock:
+            if key not in self.assets:
+                self.assets[key] = load_sound(name, volume)
+            self.acquire(owner, key)
+            return self.assets[key]
+
+    # Loads a spec as used in sprite dicts: "gfx/ship.png", ("gfx/ship.png", (48, 48)),
+    # ("sfx/collect.wav", 0.5), or an already loaded surface which is passed through
+    def load(self, spec, owner=None):
+        if isinstance(spec, pygame.Surface):
+            return spec
+        name, arg = (spec, None) if isinstance(spec, str) else spec
+        if name.endswith(SOUND_EXTENSIONS):
+            return self.sound(name, 1.0 if arg is None else arg, owner)
+        return self.image(name, arg, owner)
+
+    # Reads an image spec's cache file, or its source file on a cache miss, ahead of use.
+    # Sounds and surfaces are skipped.
+    def prefetch(self, spec) -> None:
+        if isinstance(spec, pygame.Surface):
+            return
+        name, size = (spec, None) if isinstance(spec, str) else spec
+        key = ("image", name, size)
+        if name.endswith(SOUND_EXTENSIONS):
+            return
+        with self.lock:
+            if key in self.assets or key in self.prefetched:
+                return
+
+        data = self.read_cache(self.cache_file(name, size))
+        source = None
+        if data is None:
+            with open(asset_path(name), "rb") as f:
+                source = f.read()
+        with self.lock:
+            self.prefetched[key] = (data, source)
+
+    # A dict-like view over a spec dict that loads each entry the first time it's used
+    def bundle(self, specs, owner=None) -> "AssetBundle":
+        if isinstance(specs, AssetBundle):
+            specs = specs.specs
+        return AssetBundle(self, specs, owner)
+
+    def acquire(self, owner, key) -> None:
+        keys = self.owned.setdefault(owner, set())
+        if key not in keys:
+            keys.add(key)
+            self.refcounts[key] = self.refcounts.get(key, 0) + 1
+
+    # Drops the owner's references, unloading anything no one else is using
+    def release(self, owner) -> None:
+        with self.lock:
+            for key in self.owned.pop(owner, ()):
+                self.refcounts[key] -= 1
+                if self.refcounts[key] == 0:
+                    del self.refcounts[key]
+                    del self.assets[key]
+
+    def cache_file(self, name: str, size=None) -> str:
+        stat = os.stat(asset_path(name))
+        cache_key = f"{name}|{stat.st_size}|{stat.st_mtime_ns}|{size}"
+        return os.path.join(self.cache_dir, hashlib.sha1(cache_key.encode()).hexdigest() + ".pixels")
+
+    # The cache file's contents, or None if there isn't one
+    def read_cache(self, cache_file: str) -> bytearray:
+        if not os.path.exists(cache_file):
+            return None
+        with open(cache_file, "rb") as f:
+            data = bytearray(os.fstat(f.fileno()).st_size)
+            f.readinto(data)
+        return data
+
+    def load_image(self, name: str, size=None) -> pygame.Surface:
+        filename = asset_path(name)
+        cache_file = self.cache_file(name, size)
+        # convert_alpha needs a display mode to have been set
+        can_convert = pygame.display.get_surface() is not None
+
+        with self.lock:
+            data, source = self.prefetched.pop(("image", name, size), (None, None))
+        if data is None and source is None:
+            data = self.read_cache(cache_file)
+
+        if data is not None:
+            w, h, pixel_format, converted = struct.unpack_from(self.CACHE_HEADER, data)
+            if len(data) == self.CACHE_HEADER_SIZE + w * h * 4:
+                surface = pygame.image.frombuffer(memoryview(data)[self.CACHE_HEADER_SIZE:],
+                                                  (w, h), pixel_format.decode())
+                if can_convert and not converted:
+                    surface = surface.convert_alpha()
+                return surface
+
+        if source is not None:
+            surface = pygame.image.load(io.BytesIO(source), filename)
+        else:
+            surface = pygame.image.load(filename)
+        if isinstance(size, int):
+            size = (surface.get_width() * size, surface.get_height() * size)
+        if size is not None:
+            surface = pygame.transform.scale(surface, size)
+        if can_convert:
+            surface = surface.convert_alpha()
+        self.write_cache(cache_file, surface, can_convert)
+        return surface
+
+    CACHE_HEADER = "<II4s?3x" # Padded so the pixels after it stay 4-byte aligned
+    CACHE_HEADER_SIZE = struct.calcsize(CACHE_HEADER)
+
+    def write_cache(self, cache_file: str, surface: pygame.Surface, converted: bool) -> None:
+        # Store the pixels in the surface's own channel order so loading needs no swizzle
+        pixel_format = "BGRA" if surface.get_masks()[:3] == (0xff0000, 0xff00, 0xff) else "RGBA"
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temp_file = cache_file + ".tmp"
+            with open(temp_file, "wb") as f:
+                f.write(struct.pack(self.CACHE_HEADER, *surface.get_size(),
+                                    pixel_format.encode(), converted))
+                f.write(pygame.image.tobytes(surface, pixel_format))
+            os.replace(temp_file, cache_file)
+        except OSError:
+            pass # The cache is only an optimization
+
+class AssetBundle(collections.abc.Mapping):
+    def __init__(self, manager: AssetManager, specs: dict, owner=None) -> None:
+        self.manager = manager
+        self.specs = specs
+        self.owner = owner
+        self.loaded = {}
+
+    def __getitem__(self, name: str):
+        if name not in self.loaded:
+            self.loaded[name] = self.manager.load(self.specs[name], self.owner)
+        return self.loaded[name]
+
+    def __iter__(self):
+        return iter(self.specs)
+
+    def __len__(self) -> int:
+        return len(self.specs)
+
+# Rendered text, keyed by (font name, size, text, colour, antialias), so a string is only
+# rasterized again once it changes. Fonts are shared as well. The least recently used
+# surfaces are dropped once the cached pixels add up to more than max_bytes.
+class TextCache:
+    def __init__(self, max_bytes: int = 4 * 1024 * 1024) -> None:
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.fonts = {} # (name, size) -> Font
+        self.surfaces = collections.OrderedDict() # key -> Surface, oldest first
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get_font(self, name: str, size: int) -> pygame.font.Font:
+        if (name, size) not in self.fonts:
+            self.fonts[(name, size)] = pygame.font.SysFont(name, size)
+        return self.fonts[(name, size)]
+
+    def render(self, text: str, name: str = "Calibri", size: int = 36,
+               color = "white", antialias: bool = True) -> pygame.Surface:
+        key = (name, size, text, tuple(pygame.Color(color)), antialias)
+        with self.lock:
+            surface = self.surfaces.get(key)
+            if surface is not None:
+                self.surfaces.move_to_end(key)
+                self.hits += 1
+                return surface
+
+            surface = self.get_font(name, size).render(text, antialias, color)
+            self.misses += 1
+            self.surfaces[key] = surface
+            self.bytes += surface.get_bytesize() * surface.get_width() * surface.get_height()
+            while self.bytes > self.max_bytes and len(self.surfaces) > 1:
+                _, evicted = self.surfaces.popitem(last=False)
+                self.bytes -= evicted.get_bytesize() * evicted.get_width() * evicted.get_height()
+            return surface
+
+# Shared by every widget and scene in the process
+TEXT_CACHE = TextCache()
+
+# Rotated, scaled and flipped copies of surfaces, keyed by (source, angle, scale, flip).
+# Every copy is made from the untouched source, so repeated rotations never blur or grow
+# the sprite. scale is an integer factor or a (w, h) size. Least recently used copies are
+# dropped once the cache is over max_bytes. Sources are held by id only: when a source is
+# freed (e.g. released by the asset manager) its copies are dropped with it.
+class TransformCache:
+    def __init__(self, max_bytes: int = 16 * 1024 * 1024) -> None:
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.surfaces = collections.OrderedDict() # key -> Surface, oldest first
+        self.sources = {} # id(source) -> (finalizer, set of keys cached for it)
+        self.hits = 0
+        self.misses = 0
+        # Re-entrant because a source can be collected, and forgotten, while the lock is held
+        self.lock = threading.RLock()
+
+    def get(self, source: pygame.Surface, angle: float = 0, scale = 1,
+            flip: tuple = (False, False)) -> pygame.Surface:
+        angle %= 360
+        if angle == 0 and scale == 1 and not any(flip):
+            return source
+
+        key = (id(source), angle, scale, tuple(flip))
+        with self.lock:
+            surface = self.surfaces.get(key)
+            if surface is not None:
+                self.surfaces.move_to_end(key)
+                self.hits += 1
+                return surface
+
+            surface = self.transform(source, angle, scale, flip)
+            self.misses += 1
+            self.surfaces[key] = surface
+            self.bytes += surface.get_bytesize() * surface.get_width() * surface.get_height()
+            if key[0] not in self.sources:
+                self.sources[key[0]] = (weakref.finalize(source, self.forget, key[0]), set())
+            self.sources[key[0]][1].add(key)
+            while self.bytes > self.max_bytes and len(self.surfaces) > 1:
+                self.evict(next(iter(self.surfaces)))
+            return surface
+
+    def evict(self, key) -> None:
+        evicted = self.surfaces.pop(key)
+        self.bytes -= evicted.get_bytesize() * evicted.get_width() * evicted.get_height()
+        finalizer, keys = self.sources[key[0]]
+        keys.discard(key)
+        if not keys:
+            finalizer.detach()
+            del self.sources[key[0]]
+
+    # Drops every copy of a source that has been freed
+    def forget(self, source_id: int) -> None:
+        with self.lock:
+            _, keys = self.sources.get(source_id, (None, ()))
+            for key in list(keys):
+                self.evict(key)
+
+    # Scales first, so rotation works on the final resolution
+    @staticmethod
+    def transform(source: pygame.Surface, angle: float, scale, flip: tuple) -> pygame.Surface:
+        surface = source
+        if scale != 1:
+            if isinstance(scale, int):
+                scale = (source.get_width() * scale, source.get_height() * scale)
+            surface = pygame.transform.scale(surface, scale)
+        if any(flip):
+            surface = pygame.transform.flip(surface, *flip)
+        if angle:
+            surface = pygame.transform.rotate(surface, angle)
+        return surface
+
+    # Makes the copies for `steps` evenly spaced angles up front, so turning to any of them
+    # later is a lookup. Returns them in angle order, starting at 0 degrees.
+    def rotation_atlas(self, source: pygame.Surface, steps: int = 64, scale = 1,
+                       flip: tuple = (False, False)) -> list:
+        return [self.get(source, i * 360 / steps, scale, flip) for i in range(steps)]
+
+    # The atlas copy closest to angle
+    def get_rotation(self, source: pygame.Surface, angle: float, steps: int = 64, scale = 1,
+                     flip: tuple = (False, False)) -> pygame.Surface:
+        return self.get(source, round(angle * steps / 360) % steps * 360 / steps, scale, flip)
+
+    def clear(self) -> None:
+        with self.lock:
+            for finalizer, _ in self.sources.values():
+                finalizer.detach()
+            self.sources.clear()
+            self.surfaces.clear()
+            self.bytes = 0
+
+# Shared by every scene in the process
+TRANSFORM_CACHE = TransformCache()
+
+# Draw commands for one frame. Scenes submit (surface, position, layer) during render(),
+# and the SceneManager flushes them afterwards, back to front by layer with a single
+# Surface.blits call per layer. Within a layer, commands keep their submission order.
+# Given a profiler, flush() times each layer's blits as its own section, named from
+# layer_names or "layer <n>".
+class RenderQueue:
     def __init__(self) -> None:
+        self.layers = collections.defaultdict(list) # layer -> [(surface, position[, area]), ...]
+        self.layer_names = {} # layer -> profiler section name
+        self.commands = 0 # Draw commands in the last flush
+        self.batches = 0 # blits calls in the last flush
+
+    def submit(self, surface: pygame.Surface, position, layer: int = 0, area: pygame.Rect = None) -> None:
+        if area is None:
+            self.layers[layer].append((surface, position))
+        else:
+            self.layers[layer].append((surface, position, area))
+
+    # Draws everything and empties the queue. Returns the drawn rects when asked to.
+    def flush(self, target: pygame.Surface, collect_rects: bool = False, profiler: "Profiler" = None) -> list:
+        rects = []
+        self.commands = 0
+        self.batches = 0
+        for layer in sorted(self.layers):
+            commands = self.layers[layer]
+            if profiler is None:
+                drawn = target.blits(commands, collect_rects)
+            else:
+                with profiler.section(self.layer_names.get(layer, f"layer {layer}")):
+                    drawn = target.blits(commands, collect_rects)
+            if collect_rects:
+                rects.extend(drawn)
+            self.commands += len(commands)
+            self.batches += 1
+        self.layers.clear()
+        return rects
+
+# Handles switching between scenes and drives the main loop.
+#
+# A scene's files are read ahead (Scene.prefetch) on a worker thread, and the scene is
+# then loaded (Scene.load) on the main thread, since SDL's video and font calls aren't
+# thread-safe. When a scene becomes current, the scenes it lists in next_scenes start
+# prefetching in the background. Switching to a scene that hasn't finished prefetching
+# shows a LoadingScene until it has. Headless and deterministic (recorded or replayed)
+# runs load every scene synchronously when it's first shown, so scene switches don't
+# depend on timing. The worker is shut down when the main loop ends.
+#
+# The simulation runs in fixed ticks of 1/tick_rate seconds. Real frame time is banked in
+# an accumulator and spent in whole ticks, so a slow frame runs several catch-up ticks and
+# a fast frame may run none. max_ticks caps the catch-up so a machine that can't keep up
+# drops time instead of spiralling. The leftover time in the accumulator is passed to
+# render() as alpha (0..1) so scenes can interpolate between the last two ticks.
+# When headless, frames aren't rendered and each frame advances exactly one tick
+# without waiting on the wall clock.
+class SceneManager:
+    def __init__(self,
+                 tick_rate: int = 60,
+                 max_ticks: int = 5,
+                 max_fps: int = 0,
+                 headless: bool = None) -> None:
         self.scenes = {}
+        self.current_scene = None
         self.quit = False
+        self.headless = HEADLESS if headless is None else headless
+
+        self.loader = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.loading = {} # scene -> Future of its load()
+        self.pending_scene = None # Name of the scene to switch to once it has loaded
+        self.loading_scene = None
+
+        self.recording = None # InputRecording that every frame is appended to
+        self.frame = 0
+        self.profiler = Profiler()
+        self.assets = AssetManager()
+        self.render_queue = RenderQueue()
 
+        self.tick_rate = tick_rate
+        self.tick_dt = 1 / tick_rate
+        self.max_ticks = max_ticks
+        self.max_fps = max_fps # 0 means uncapped
+        self.accumulator = 0.0
+        self.clock = pygame.time.Clock()
+
+    # The starting scene is loaded up front, since there is nothing else to show yet
     def initialize(self, scenes: dict, starting_scene: str) -> None:
         self.scenes = scenes
-        self.current_scene = self.scenes[starting_scene]
+        self.finish_loading(self.scenes[starting_scene])
+        self.set_scene(starting_scene)
 
     def set_scene(self, new_scene: str) -> None:
-        self.current_scene = self.scenes[new_scene]
+        scene = self.scenes[new_scene]
+        if not scene.loaded:
+            if self.loads_synchronously() or (scene in self.loading and self.loading[scene].done()):
+                self.finish_loading(scene)
+            else:
+                self.preload(new_scene)
+                self.pending_scene = new_scene
+                self.show(self.get_loading_scene())
+                return
+
+        self.pending_scene = None
+        self.show(scene)
+        if not self.loads_synchronously():
+            for name in scene.next_scenes:
+                self.preload(name)
+
+    def loads_synchronously(self) -> bool:
+        return self.headless or DETERMINISTIC
+
+    def show(self, scene) -> None:
+        self.current_scene = scene
+        scene.full_redraw = True
+
+    # Starts prefetching a scene on the worker thread if it isn't loaded or loading already
+    def preload(self, name: str) -> None:
+        scene = self.scenes[name]
+        if not scene.loaded and scene not in self.loading:
+            self.loading[scene] = self.loader.submit(scene.prefetch)
+
+    # Waits for a scene's background prefetch to complete (re-raising anything it threw),
+    # or prefetches it right here if it was never started, then loads it
+    def finish_loading(self, scene) -> None:
+        if scene in self.loading:
+            self.loading.pop(scene).result()
+        else:
+            scene.prefetch()
+        scene.load()
+        scene.loaded = True
+
+    def get_loading_scene(self):
+        if self.loading_scene is None:
+            self.loading_scene = LoadingScene(self, pygame.display.get_surface())
+        return self.loading_scene
+
+    def check_pending_scene(self) -> None:
+        scene = self.scenes[self.pending_scene]
+        if self.loading[scene].done():
+            self.finish_loading(scene)
+            self.set_scene(self.pending_scene)
 
     def get_scene(self) -> None:
         return self.current_scene
 
+    # Replaces (or adds) a scene, releasing the assets only the old one was using
+    def replace_scene(self, name: str, scene) -> None:
+        old_scene = self.scenes.get(name)
+        self.scenes[name] = scene
+        if old_scene in self.loading:
+            self.finish_loading(old_scene)
+        if old_scene is not None and self.current_scene is old_scene:
+            self.set_scene(name)
+        if old_scene is not None:
+            self.assets.release(old_scene)
+
+    # Puts a scene back in its initial state, keeping everything it has loaded
+    def reset_scene(self, name: str) -> None:
+        scene = self.scenes[name]
+        if scene in self.loading:
+            self.finish_loading(scene)
+        if scene.loaded:
+            scene.reset()
+
+    def remove_scene(self, name: str) -> None:
+        scene = self.scenes.pop(name)
+        if scene in self.loading:
+            self.finish_loading(scene)
+        self.assets.release(scene)
+
     def quit_game(self) -> None:
         self.quit = True
 
+    # Stops the loader thread, dropping any prefetch that hasn't started
+    def shutdown(self) -> None:
+        self.loader.shutdown(wait=True, cancel_futures=True)
+        self.loading.clear()
+
+    # Runs a single frame: input, as many fixed ticks as the banked time allows, then render
+    def step(self, frame_time: float, events: list) -> None:
+        profiler = self.profiler
+        profiler.begin_frame()
+
+        if self.pending_scene is not None:
+            self.check_pending_scene()
+
+        if self.recording is not None:
+            self.recording.record(frame_time, events)
+
+        with profiler.section("events"):
+            for event in events:
+                if event.type == pygame.KEYDOWN:
+                    if event.key == Profiler.OVERLAY_KEY:
+                        profiler.toggle_overlay()
+                    elif event.key == Profiler.DUMP_KEY:
+                        profiler.dump(time.strftime("profile_%Y%m%d_%H%M%S.csv"))
+            self.current_scene.poll_events(events)
+
+        with profiler.section("update"):
+            self.accumulator += frame_time
+            ticks = 0
+            while self.accumulator >= self.tick_dt:
+                if ticks == self.max_ticks: # Too far behind, drop the backlog
+                    self.accumulator = 0.0
+                    break
+                self.current_scene.update(self.tick_dt)
+                self.accumulator -= self.tick_dt
+                ticks += 1
+
+        self.frame += 1
+        if self.headless:
+            profiler.end_frame()
+            return
+
+        scene = self.current_scene
+        with profiler.section("render"):
+            scene.render(self.accumulator / self.tick_dt)
+            drawn = self.render_queue.flush(scene.screen, scene.dirty_rects, profiler)
+            for rect in drawn:
+                scene.mark_dirty(rect)
+            profiler.count("draws", self.render_queue.commands)
+            profiler.count("batches", self.render_queue.batches)
+            if profiler.show_overlay:
+                scene.mark_dirty(profiler.render_overlay(scene.screen))
+
+        with profiler.section("present"):
+            rects = scene.get_update_rects()
+            if rects is None:
+                pygame.display.update()
+            else:
+                pygame.display.update(rects)
+
+        profiler.end_frame()
+
+    # Steps the current scene as fast as possible, one tick per frame, with no rendering.
+    # Events posted with pygame.event.post (e.g. by a bot) are delivered as usual.
+    def simulate(self, frames: int = None) -> None:
+        start = self.frame
+        while not self.quit and (frames is None or self.frame - start < frames):
+            self.step(self.tick_dt, pygame.event.get())
+
+    # MAIN GAME LOOP #
+    def run(self, frames: int = None, profile_file: str = None) -> None:
+        try:
+            if self.headless:
+                self.simulate(frames)
+            else:
+                self.run_realtime(frames)
+        finally:
+            self.shutdown()
+
+        if profile_file is not None:
+            self.profiler.dump(profile_file)
+
+    # Feeds a recording's frames through step(), as fast as possible or at recorded speed
+    def play(self,
+             recording: "InputRecording",
+             realtime: bool = False,
+             frames: int = None,
+             profile_file: str = None) -> None:
+        count = len(recording.frames) if frames is None else min(frames, len(recording.frames))
+        try:
+            for i in range(count):
+                if self.quit:
+                    break
+                start = time.perf_counter()
+                frame_time, events = recording.get_frame(i)
+                pygame.event.pump() # Keep the window responsive, live input is ignored
+                self.step(frame_time, events)
+                if realtime:
+                    time.sleep(max(0.0, frame_time - (time.perf_counter() - start)))
+        finally:
+            self.shutdown()
+
+        if profile_file is not None:
+            self.profiler.dump(profile_file)
+
+    def run_realtime(self, frames: int = None) -> None:
+        start = self.frame
+        previous_time = time.perf_counter()
+        while not self.quit and (frames is None or self.frame - start < frames):
+            now = time.perf_counter()
+            frame_time = now - previous_time
+            previous_time = now
+
+            self.step(frame_time, pygame.event.get())
+
+            if self.max_fps > 0:
+                self.clock.tick(self.max_fps)
+
 # A scene is a collection of objects that are set to be updated and rendered
 # in any given frame. It allows us to quickly switch between, for instance, a start menu
 # and the main game scene, or different areas in an RPG.
+# update() receives the fixed tick length, render() receives the interpolation alpha and
+# poll_events() receives the events the SceneManager pulled for this frame.
+#
+# Scenes can opt into dirty-rect rendering by setting self.dirty_rects and giving a
+# self.background surface. render() then starts with begin_frame(), which restores the
+# background only under whatever was drawn last frame, and reports everything it draws
+# with mark_dirty(). Only the old and new rects are pushed to the display.
+#
+# sprites is a dict of names to asset specs (see AssetManager.load). The scene owns its
+# references, so they're released when the SceneManager drops the scene.
+#
+# Reading files belongs in prefetch(), which the SceneManager may run on a worker thread
+# while another scene is playing, so it must not create surfaces, render text or touch
+# the display. Building everything else (tilemaps, tilesets, text) belongs in load(),
+# which runs on the main thread once prefetch() has finished. next_scenes names the
+# scenes that are likely to follow this one, so they can be preloaded.
+# reset() must restore the state the scene had right after load(), reusing what it
+# already loaded, so restarting doesn't mean rebuilding the scene.
 class Scene:
+    next_scenes = []
+
     def __init__(self, manager: SceneManager, 
                  screen: pygame.Surface, 
                  sprites: dict) -> None:
         self.manager = manager
         self.screen = screen
-        self.sprites = sprites
+        self.sprites = manager.assets.bundle(sprites, self)
+        self.loaded = False
 
-    def update(self) -> None:
+        self.dirty_rects = False
+        self.background = None
+        self.full_redraw = True
+        self.drawn = [] # Rects drawn this frame
+        self.previous_drawn = [] # Rects drawn last frame, now cleared back to background
+
+    # Runs before load(), possibly on a worker thread.
+    # The default reads ahead every image in the scene's sprite dict.
+    def prefetch(self) -> None:
+        for spec in self.sprites.specs.values():
+            self.manager.assets.prefetch(spec)
+
+    # Runs on the main thread before the scene is first shown.
+    # The default loads every asset in the scene's sprite dict.
+    def load(self) -> None:
+        for name in self.sprites:
+            self.sprites[name]
+
+    def reset(self) -> None:
         pass
 
-    def render(self) -> None:
+    def update(self, dt: float) -> None:
         pass
 
-    def poll_events(self) -> None:
+    def render(self, alpha: float) -> None:
         pass
 
+    def poll_events(self, events: list) -> None:
+        pass
+
+    # Clears the screen back to the background. Returns True when the whole screen was
+    # repainted (first frame of the scene, or not in dirty-rect mode).
+    def begin_frame(self) -> bool:
+        full = self.full_redraw or not self.dirty_rects
+        if full:
+            self.screen.blit(self.background, (0, 0))
+            self.previous_drawn = []
+        else:
+            for rect in self.drawn:
+                self.screen.blit(self.background, rect, rect)
+            self.previous_drawn = self.drawn
+        self.drawn = []
+        return full
+
+    def mark_dirty(self, rect: pygame.Rect) -> None:
+        self.drawn.append(rect)
+
+    # Rects to pass to pygame.display.update, or None to update the whole screen
+    def get_update_rects(self) -> list:
+        if not self.dirty_rects or self.full_redraw:
+            self.full_redraw = False
+            return None
+        return merge_rects(self.previous_drawn + self.drawn)
+
+# Shown while the scene being switched to finishes loading
+class LoadingScene(Scene):
+    def __init__(self, manager: SceneManager, screen: pygame.Surface) -> None:
+        super().__init__(manager, screen, {})
+        self.loaded = True
+        self.text = TEXT_CACHE.render("Loading...", "Arial", 36)
+
+    def render(self, alpha: float) -> None:
+        self.screen.fill("black")
+        self.screen.blit(self.text, self.text.get_rect(center=self.screen.get_rect().center))
+
+    def poll_events(self, events: list) -> None:
+        for event in events:
+            if event.type == pygame.QUIT:
+                self.manager.quit_game()
+
+# Merges overlapping rects so each screen area is only pushed once
+def merge_rects(rects: list) -> list:
+    merged = []
+    for rect in rects:
+        rect = rect.copy()
+        i = rect.collidelist(merged)
+        while i != -1:
+            rect.union_ip(merged.pop(i))
+            i = rect.collidelist(merged)
+        merged.append(rect)
+    return merged
@@ -1,7 +1,16 @@
 import pygame
 import random
-import time
+from pygame_util import SceneManager, Scene, Entity, EntityStore, RenderQueue, TEXT_CACHE, TRANSFORM_CACHE, init_display, play_music, run_from_command_line
 
+# Unit vectors for the four movement directions
+DIRECTIONS = {"up": (0, -1),
+              "down": (0, 1),
+              "left": (-1, 0),
+              "right": (1, 0)}
+
+# Render queue layers, back to front
+LAYER_SPRITES = 0
+LAYER_HUD = 1
 
 class collectible:
     def __init__(self, x: float, y: float, sprite: pygame.surface) -> None:
@@ -13,8 +22,8 @@ class collectible:
     def update(self) -> None:
         pass
 
-    def render(self, screen: pygame.surface) -> None:
-        screen.blit(self.sprite, (self.x, self.y))
+    def render(self, queue: RenderQueue) -> None:
+        queue.submit(self.sprite, (self.x, self.y), LAYER_SPRITES)
 
     def randomize_postion(self) -> None:
         self.x = random.randint(50, 1250)
@@ -23,43 +32,35 @@ class collectible:
         self.rect.y = self.y
 
 
-class player:
-    def __init__(self, x: float, y: float, sprite: pygame.surface) -> None:
-        self.x = x
-        self.y = y
+# Position and motion live in the scene's EntityStore
+class player(Entity):
+    def __init__(self, store: EntityStore, x: float, y: float, sprite: pygame.surface) -> None:
+        super().__init__(store, x, y, sprite.get_width(), sprite.get_height())
+        self.original_sprite = sprite
         self.sprite = sprite
+        # The ship only ever faces one of the four directions
+        TRANSFORM_CACHE.rotation_atlas(sprite, 4)
         self.velocity = 200
         self.max_velocity = 700
         self.angle = 0
         self.direction = "up"
         self.moving = False
-        self.rect = self.sprite.get_rect()
 
+    # Sets the stored velocity for this tick, before the store integrates it
     def update(self, dt) -> None:
-        if self.moving:
-            self.move(dt)
-
-        self.rect.x = int(self.x)
-        self.rect.y = int(self.y)
+        speed = self.velocity if self.moving else 0
+        self.vx = DIRECTIONS[self.direction][0] * speed
+        self.vy = DIRECTIONS[self.direction][1] * speed
 
-    def render(self, screen: pygame.surface) -> None:
-        screen.blit(self.sprite, (self.x, self.y))
+    def render(self, queue: RenderQueue, alpha: float) -> None:
+        queue.submit(self.sprite, self.get_render_pos(alpha), LAYER_SPRITES)
 
     def set_angle(self, new_angle: int) -> None:
-        rotation = new_angle - self.angle
-        self.sprite = pygame.transform.rotate(self.sprite, rotation)
+        self.sprite = TRANSFORM_CACHE.get(self.original_sprite, new_angle)
         self.angle = new_angle
 
-    def move(self, dt) -> None:
-        if self.direction == "up":
-            self.y -= self.velocity * dt
-        elif self.direction == "down":
-            self.y += self.velocity * dt
-        elif self.direction == "left":
-            self.x -= self.velocity * dt
-        elif self.direction == "right":
-            self.x += self.velocity * dt
-
+    # Keeps the ship inside the screen border after it has moved
+    def clamp(self) -> None:
         self.x = min((1280 - 48 - 5, self.x))
         self.x = max((5, self.x))
 
@@ -72,66 +73,119 @@ class Text:
         self.x = x
         self.y = y
         self.text = text
-        self.font = pygame.font.SysFont("Calibri", 36)
 
     def updat(self) -> None:
         pass
 
-    def render(self, screen: pygame.surface) -> None:
-        self.rendered = self.font.render(self.text, True, "white")
-        screen.blit(self.rendered, (self.x, self.y))
+    def get_surface(self) -> pygame.Surface:
+        return TEXT_CACHE.render(self.text, "Calibri", 36, "white")
 
+    # Draws straight onto a surface, for text baked into a scene background
+    def bake(self, surface: pygame.Surface) -> None:
+        surface.blit(self.get_surface(), (self.x, self.y))
 
-class Game:
-    def __init__(self) -> None:
-        pygame.init()
-        self.running = True
-        self.paused = False  # New state for pause
-        self.screen = pygame.display.set_mode((1280, 720))
-        self.sprites = self.load_sprites()
+    def render(self, queue: RenderQueue) -> None:
+        queue.submit(self.get_surface(), (self.x, self.y), LAYER_HUD)
 
-        self.score = 0
 
-        self.player = player(200, 200, self.sprites["spaceship"])
-        self.collectible = collectible(500, 500, self.sprites["collectible"])
-        self.collectible.randomize_postion()
-        self.text = Text(600, 50, str(self.score))
+class StartScene(Scene):
+    next_scenes = ["main"]
+
+    def __init__(self,
+                 manager: SceneManager,
+                 screen: pygame.Surface,
+                 sprites: dict) -> None:
+        super().__init__(manager, screen, sprites)
+
+        self.start_text = Text(500, 300, "Press any key to start")
+        self.title_text = Text(500, 200, "Welcome to the Game")
+
+        # Nothing on this screen moves, so it is all baked into the background
+        self.dirty_rects = True
+        self.background = pygame.Surface(self.screen.get_size())
+        self.background.blit(self.sprites["background"], (0, 0))
+        self.title_text.bake(self.background)
+        self.start_text.bake(self.background)
+
+    def render(self, alpha: float) -> None:
+        self.begin_frame()
+
+    def poll_events(self, events: list) -> None:
+        for event in events:
+            if event.type == pygame.QUIT:
+                self.manager.quit_game()
+            if event.type == pygame.KEYDOWN:
+                self.manager.set_scene("main")
+
+
+class PauseScene(Scene):
+    next_scenes = ["main"]
+
+    def __init__(self,
+                 manager: SceneManager,
+                 screen: pygame.Surface,
+                 sprites: dict) -> None:
+        super().__init__(manager, screen, sprites)
+
+        self.pause_text = Text(540, 300, "Paused")
+        self.quit_text = Text(480, 400, "Press Q to Quit")
+
+        self.dirty_rects = True
+        self.background = pygame.Surface(self.screen.get_size())
+        self.pause_text.bake(self.background)
+        self.quit_text.bake(self.background)
+
+    def render(self, alpha: float) -> None:
+        self.begin_frame()
+
+    def poll_events(self, events: list) -> None:
+        for event in events:
+            if event.type == pygame.QUIT:
+                self.manager.quit_game()
+            if event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_q:
+                    self.manager.quit_game()  # Quit game from pause menu
+                if event.key == pygame.K_ESCAPE:
+                    self.manager.set_scene("main")  # Unpause with ESC
+
+
+class MainScene(Scene):
+    next_scenes = ["pause"]
+
+    def __init__(self,
+                 manager: SceneManager,
+                 screen: pygame.Surface,
+                 sprites: dict) -> None:
+        super().__init__(manager, screen, sprites)
+
+        self.score = 0
 
         self.keybinds = {pygame.K_w: (0, "up"),
                          pygame.K_d: (270, "right"),
                          pygame.K_s: (180, "down"),
                          pygame.K_a: (90, "left")}
 
-        pygame.mixer.music.load("Games\sfx\music.ogg")
-        pygame.mixer.music.set_volume(0.25)
-        pygame.mixer.music.play()
-
-        self.collect_sound = pygame.mixer.Sound("Games\sfx\collect.wav")
-        self.collect_sound.set_volume(0.5)
-
-    def show_start_screen(self) -> None:
-        start_text = Text(500, 300, "Press any key to start")
-        title_text = Text(500, 200, "Welcome to the Game")
-
-        self.screen.fill("black")
-        self.screen.blit(self.sprites["background"], (0, 0))
-        title_text.render(self.screen)
-        start_text.render(self.screen)
-        pygame.display.update()
-
-        waiting = True
-        while waiting:
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    self.running = False
-                    waiting = False
-                if event.type == pygame.KEYDOWN:
-                    waiting = False
-
-    def poll_events(self) -> None:
-        for event in pygame.event.get():
+    def load(self) -> None:
+        super().load()
+
+        self.entities = EntityStore()
+        self.player = player(self.entities, 200, 200, self.sprites["spaceship"])
+        self.collectible = collectible(500, 500, self.sprites["collectible"])
+        self.collectible.randomize_postion()
+        self.text = Text(600, 50, str(self.score))
+
+        self.collect_sound = self.sprites["collect_sound"]
+
+        # Only the ship, the collectible and the score are redrawn each frame
+        self.dirty_rects = True
+        self.background = pygame.Surface(self.screen.get_size())
+        pygame.draw.rect(self.background, "red", pygame.Rect(0, 0, 1280, 720), 5)
+        self.background.blit(self.sprites["background"], (0, 0))
+
+    def poll_events(self, events: list) -> None:
+        for event in events:
             if event.type == pygame.QUIT:
-                self.running = False
+                self.manager.quit_game()
 
             if event.type == pygame.KEYDOWN:
                 if event.key in self.keybinds:
@@ -139,42 +193,18 @@ class Game:
                     self.player.direction = self.keybinds[event.key][1]
                     self.player.moving = True
 
-                # Pause/unpause with ESC key
+                # Pause with ESC key
                 if event.key == pygame.K_ESCAPE:
-                    self.paused = not self.paused  # Toggle pause state
+                    self.manager.set_scene("pause")
 
             if event.type == pygame.KEYUP:
                 if event.key in self.keybinds and self.keybinds[event.key][1] == self.player.direction:
                     self.player.moving = False
 
-    def pause_screen(self) -> None:
-        pause_text = Text(540, 300, "Paused")
-        quit_text = Text(480, 400, "Press Q to Quit")
-
-        self.screen.fill("black")
-        pause_text.render(self.screen)
-        quit_text.render(self.screen)
-        pygame.display.update()
-
-        while self.paused:
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    self.running = False
-                    self.paused = False
-                if event.type == pygame.KEYDOWN:
-                    if event.key == pygame.K_q:
-                        self.running = False  # Quit game from pause menu
-                        self.paused = False
-                    if event.key == pygame.K_ESCAPE:
-                        self.paused = False  # Unpause with ESC
-
-    def update(self) -> None:
-        # compute delta time
-        now = time.time()
-        dt = now - self.previous_time
-        self.previous_time = now
-
+    def update(self, dt: float) -> None:
         self.player.update(dt)
+        self.entities.integrate(dt)
+        self.player.clamp()
         self.collectible.update()
 
         if self.player.rect.colliderect(self.collectible.rect):
@@ -188,45 +218,40 @@ class Game:
         self.text.updat()
         self.text.text = str(self.score)
 
-    def render(self) -> None:
-        self.screen.fill("black")
+    def render(self, alpha: float) -> None:
+        self.begin_frame()
 
-        pygame.draw.rect(self.screen, "red", pygame.Rect(0, 0, 1280, 720), 5)
+        # The manager marks the queued draws dirty when it flushes them
+        queue = self.manager.render_queue
+        self.player.render(queue, alpha)
+        self.collectible.render(queue)
+        self.text.render(queue)
 
-        self.screen.blit(self.sprites["background"], (0, 0))
-        self.player.render(self.screen)
-        self.collectible.render(self.screen)
-        self.text.render(self.screen)
 
-        pygame.display.update()
+# Assets used by the scenes, loaded on first use. The ship is downscaled on load.
+ASSETS = {"spaceship": ("gfx/ship.png", (48, 48)),
+          "background": "gfx/simple_game_bg.png",
+          "collectible": "gfx/collectible.png",
+          "collect_sound": ("sfx/collect.wav", 0.5)}
 
-    def run(self) -> None:
-        self.show_start_screen()  # Display the start screen
-        self.previous_time = time.time()
-        while self.running:
-            self.poll_events()
-            if self.paused:
-                self.pause_screen()  # Show pause screen when paused
-            else:
-                self.update()
-                self.render()
-        pygame.quit()
 
-    def load_sprites(self) -> dict:
-        sprites = {}
+class Game:
+    def __init__(self, headless: bool = False, starting_scene: str = "start") -> None:
+        self.screen = init_display((1280, 720), headless)
+        self.sprites = ASSETS
+
+        self.scene_manager = SceneManager()
+        scenes = {"start": StartScene(self.scene_manager, self.screen, self.sprites),
+                  "main": MainScene(self.scene_manager, self.screen, self.sprites),
+                  "pause": PauseScene(self.scene_manager, self.screen, self.sprites)}
+        self.scene_manager.initialize(scenes, starting_scene)
 
-        sprites["spaceship"] = pygame.image.load(
-            "Games\gfx\ship.png").convert_alpha()
-        sprites["background"] = pygame.image.load(
-            "Games\gfx\simple_game_bg.png").convert_alpha()
-        sprites["collectible"] = pygame.image.load(
-            "Games\gfx\collectible.png").convert_alpha()
-        # Downscale
-        sprites["spaceship"] = pygame.transform.scale(
-            sprites["spaceship"], (48, 48))
+        play_music("sfx/music.ogg", 0.25)
 
-        return sprites
+    def run(self, frames: int = None, profile_file: str = None) -> None:
+        self.scene_manager.run(frames, profile_file)
+        pygame.quit()
 
 
-g = Game()
-g.run()
+if __name__ == "__main__":
+    run_from_command_line(Game, "start")
@@ -0,0 +1,111 @@
+import argparse, base64, gzip, json, zlib
+import numpy as np
+from pygame_util import TileMapFile
+
+# Converts a map saved from Tiled as JSON into the game's binary tile map format:
+#   python tiled_import.py maps/overworld.json maps/overworld.tmap
+# Every tile layer becomes one layer of the output, in drawing order (group layers are
+# flattened). Tile ids are written relative to the tileset, so the first tile in the
+# sheet is 0, and empty cells become TileMapFile.EMPTY. Flip and rotation flags are
+# dropped. Finite and infinite maps are supported, and so are CSV and base64 data, with
+# or without zlib or gzip compression.
+
+# The top three bits of a Tiled gid are flip flags, the fourth marks hexagonal rotation
+GID_MASK = 0x0FFFFFFF
+
+def decode_data(data, encoding: str, compression: str) -> np.ndarray:
+    if encoding != "base64":
+        return np.asarray(data, dtype=np.uint32)
+
+    raw = base64.b64decode(data)
+    if compression == "zlib":
+        raw = zlib.decompress(raw)
+    elif compression == "gzip":
+        raw = gzip.decompress(raw)
+    elif compression:
+        raise ValueError(f"unsupported layer compression: {compression}")
+    return np.frombuffer(raw, dtype="<u4")
+
+def tile_layers(layers: list) -> list:
+    found = []
+    for layer in layers:
+        if layer["type"] == "tilelayer":
+            found.append(layer)
+        elif layer["type"] == "group":
+            found.extend(tile_layers(layer.get("layers", [])))
+    return found
+
+# Turns a layer's gids into a (height, width) grid of raw gids, placing the chunks of an
+# infinite map relative to the map's top left corner
+def layer_grid(layer: dict, left: int, top: int, width: int, height: int) -> np.ndarray:
+    encoding = layer.get("encoding", "csv")
+    compression = layer.get("compression", "")
+    grid = np.zeros((height, width), dtype=np.uint32)
+
+    if "chunks" in layer:
+        for chunk in layer["chunks"]:
+            gids = decode_data(chunk["data"], encoding, compression).reshape(chunk["height"], chunk["width"])
+            x = chunk["x"] - left
+            y = chunk["y"] - top
+            grid[y:y + chunk["height"], x:x + chunk["width"]] = gids
+    else:
+        gids = decode_data(layer["data"], encoding, compression).reshape(layer["height"], layer["width"])
+        x = layer.get("startx", 0) - left
+        y = layer.get("starty", 0) - top
+        grid[y:y + layer["height"], x:x + layer["width"]] = gids
+    return grid
+
+# Bounds (left, top, width, height) in tiles covering every layer of the map
+def map_bounds(tiled: dict, layers: list) -> tuple:
+    if not tiled.get("infinite"):
+        return 0, 0, tiled["width"], tiled["height"]
+
+    chunks = [chunk for layer in layers for chunk in layer.get("chunks", [])]
+    if not chunks:
+        return 0, 0, 0, 0
+    left = min(chunk["x"] for chunk in chunks)
+    top = min(chunk["y"] for chunk in chunks)
+    right = max(chunk["x"] + chunk["width"] for chunk in chunks)
+    bottom = max(chunk["y"] + chunk["height"] for chunk in chunks)
+    return left, top, right - left, bottom - top
+
+def convert(tiled: dict) -> np.ndarray:
+    if tiled.get("orientation", "orthogonal") != "orthogonal":
+        raise ValueError("only orthogonal maps are supported")
+    tilesets = tiled.get("tilesets", [])
+    if len(tilesets) != 1:
+        raise ValueError(f"expected one tileset, found {len(tilesets)}")
+    first_gid = tilesets[0]["firstgid"]
+
+    layers = tile_layers(tiled["layers"])
+    if not layers:
+        raise ValueError("the map has no tile layers")
+    left, top, width, height = map_bounds(tiled, layers)
+
+    output = np.full((len(layers), height, width), TileMapFile.EMPTY, dtype=np.uint16)
+    for i, layer in enumerate(layers):
+        gids = layer_grid(layer, left, top, width, height) & GID_MASK
+        used = gids != 0
+        if used.any() and (gids[used].min() < first_gid or gids[used].max() - first_gid >= TileMapFile.EMPTY):
+            raise ValueError(f"layer {layer.get('name', i)!r} has tile ids outside the tileset")
+        output[i][used] = gids[used] - first_gid
+    return output
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Convert a Tiled JSON map into a binary tile map")
+    parser.add_argument("source", help="map saved from Tiled as .json")
+    parser.add_argument("output", help="tile map file to write, usually .tmap")
+    parser.add_argument("--chunk-size", type=int, default=16,
+                        help="tiles per chunk side, a multiple of 8 (default 16)")
+    args = parser.parse_args()
+    if args.chunk_size <= 0 or args.chunk_size % 8 != 0:
+        parser.error("--chunk-size must be a positive multiple of 8")
+
+    with open(args.source) as f:
+        tiled = json.load(f)
+    layers = convert(tiled)
+    TileMapFile.save(args.output, layers, args.chunk_size)
+    print(f"{args.output}: {layers.shape[2]}x{layers.shape[1]} tiles, {layers.shape[0]} layer(s)")
+
+if __name__ == "__main__":
+    main()